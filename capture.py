@@ -1,4 +1,5 @@
 import os
+import socket
 import struct
 import time
 
@@ -11,46 +12,143 @@ except ImportError:
     print "\tpython-numpy"
     exit(1)
 
-try:
-    import gzip
-except ImportError:
-    pass
-
 import hphelper
+import dumpwriter
 
 
 options = hphelper.options
 DEBUG = hphelper.DEBUG
+INFO = hphelper.INFO
 ERROR = hphelper.err
 
+# ICMP type, sequence and slot number of a captured probe frame
+# (ICMP at offset 34, seq and slot at 34+16)
+ICMP_DTYPE = np.dtype({'names':['type','seq','slot'], 'formats':['u1','>u4','>u4'],
+                       'offsets':[34,50,54], 'itemsize':58})
+
+
+def decode_frames(frames):
+    """Copies a list of captured frames into a contiguous buffer (each
+    frame truncated or zero padded to ICMP_DTYPE.itemsize bytes) and
+    returns an ICMP_DTYPE view of the buffer"""
+    buf = np.array(frames, dtype='S%d' % ICMP_DTYPE.itemsize)
+    return buf.view(ICMP_DTYPE)
+
+
+class send_table(object):
+    """Send times of the outstanding echo requests, stored in a ring of
+    window entries indexed by seq modulo window, so the memory does not
+    depend on the number of probes. A request whose entry is reused by
+    the request window sequence numbers later before its reply was
+    captured has expired, i.e., it is counted as lost. Replies to
+    expired requests (late), replies which were already matched
+    (duplicate) and replies without a captured request (unmatched) are
+    counted and dropped. The 32 bit sequence numbers are unwrapped, so
+    the table also works across the wrap-around in continuous runs."""
+
+    def __init__(self, window):
+        self.window = window
+        self.seqs = -np.ones(window, dtype=np.int64)    # seq of the outstanding request
+        self.times = np.zeros(window)                   # send time of the outstanding request
+        self.done = -np.ones(window, dtype=np.int64)    # seq of the last answered request
+        self.max_seq = -1
+        self._seq = hphelper.counter32()
+        self.expired = 0
+        self.late = 0
+        self.duplicate = 0
+        self.unmatched = 0
+
+    def add(self, seq, ts):
+        """Store the send times ts of the requests seq (unwrapped)"""
+        if not len(seq): return
+        if not np.all(seq[1:] > seq[:-1]):
+            # sort and drop repeated requests
+            (seq, first) = np.unique(seq, return_index=True)
+            ts = ts[first]
+        idx = seq % self.window
+        old = self.seqs[idx]
+        new = old != seq                                # ignore repeated requests
+        if not new.all():
+            (seq, ts, idx, old) = (seq[new], ts[new], idx[new], old[new])
+            if not len(seq): return
+        # overwritten requests expire, including those within the batch
+        self.expired += np.sum(old != -1)
+        if seq[-1] - seq[0] >= self.window:
+            self.expired += len(idx) - len(np.unique(idx))
+        self.seqs[idx] = seq
+        self.times[idx] = ts
+        if seq[-1] > self.max_seq:
+            self.max_seq = seq[-1]
+
+    def match(self, seq, slot, ts, req, rep):
+        """Stores the timestamps ts of the echo requests (mask req) and
+        returns the PROBE_DTYPE records of the echo replies (mask rep)
+        whose request is outstanding, in the order of the replies"""
+        seq64 = self._seq.unwrap(seq)
+        self.add(seq64[req], ts[req])
+
+        (seq, slot, ts, seq64) = (seq[rep], slot[rep], ts[rep], seq64[rep])
+        idx = seq64 % self.window
+        hit = self.seqs[idx] == seq64
+        pos = np.flatnonzero(hit)
+        if not np.all(seq64[pos[1:]] > seq64[pos[:-1]]):
+            # a reply repeated within the batch is matched once
+            first = np.unique(seq64[pos], return_index=True)[1]
+            hit[pos] = False
+            hit[pos[first]] = True
+
+        recs = np.empty(np.sum(hit), dtype=hphelper.PROBE_DTYPE)
+        recs['seq'] = seq[hit]
+        recs['slot'] = slot[hit]
+        recs['rtt'] = ts[hit] - self.times[idx[hit]]    # use captured send time to calculate RTT
+        self.seqs[idx[hit]] = -1
+        self.done[idx[hit]] = seq64[hit]
+
+        miss = ~hit
+        dup = miss & (self.done[idx] == seq64)
+        late = miss & ~dup & (seq64 + self.window <= self.max_seq)
+        self.duplicate += np.sum(dup)
+        self.late += np.sum(late)
+        self.unmatched += np.sum(miss & ~dup & ~late)
+        return recs
+
+    def outstanding(self):
+        """Number of requests still waiting for a reply"""
+        return np.sum(self.seqs != -1)
+
+    def pprint(self):
+        INFO('send table', '%d entries (%.1f MB)' % (self.window, (self.seqs.nbytes+self.times.nbytes+self.done.nbytes)/2.0**20))
+        for (name, n) in [('expired requests', self.expired), ('unanswered requests', self.outstanding()),
+                          ('late replies', self.late), ('duplicate replies', self.duplicate),
+                          ('unmatched replies', self.unmatched)]:
+            if n:
+                INFO(name, n)
+
+
 ################################################################################
 def rcvloop(data_pipe, ns, geotimes=None):
     """receive ICMP packets from pcap, extract sequence number and
-    timestamp and forward to parser over pipe q"""
-
-    if ns.cnum:
-        pnum = ns.cnum
-    else:
-        pnum = options.pnum
+    timestamp and forward to parser over pipe q. The packets of each
+    pcap buffer are collected and decoded at once."""
 
     hphelper.set_affinity('rcvloop')
     ttl=None
 
-    struct_unpack = struct.unpack
+    times = []
+    frames = []
+    itemsize = ICMP_DTYPE.itemsize
     def pcap_cb(time, pkt):
-        (icmp_type,) = struct_unpack('!B',pkt[34:34+1])
-        (seq,slot) = struct_unpack('!LL',pkt[50:58])          # ICMP (offset 34) + 16:50+4+4
-        if icmp_type==8:                                    # ICMP echo request
-            s_times[seq] = time                             # store send time
-        elif icmp_type==0:                                  # ICMP echo reply
-            snd_time = s_times[seq]                         # use captured send time to calculate RTT 
-            data_pipe.send((seq, slot, time-snd_time))      # send to parser process 
-            #(ttl,) = struct_unpack('!B',pkt[22:22+1])        # 14 Ethernet 14 + 8 IP  
+        # copy: pkt may point into the pcap buffer reused after dispatch
+        times.append(time)
+        frames.append(str(pkt[:itemsize]))
 
     DEBUG('starting receiver ', __name__)
 
-    # init empty numpy arrays to store snd/rcv times
-    s_times = -1.0*np.ones(pnum)
+    # send times of the outstanding requests
+    table = send_table(options.seq_window)
+
+    # collect (seq, slot, rtt) records and send them in batches
+    batch = hphelper.batch_writer(data_pipe)
 
     try:
         po = pcap.pcap(options.eth, snaplen=80, immediate=False, timeout_ms=3000) # timeout_ms works with dispatch only
@@ -66,18 +164,66 @@ def rcvloop(data_pipe, ns, geotimes=None):
     # notify sender that we are ready to capture
     ns.RCV_READY = True
     # block until sender says it is ready
-    while not ns.SND_READY:
-        time.sleep(0.1)
+    ns.wait_ready(rcv=False)
 
     DEBUG('READY', __name__)
     try:
         while po_dispatch(0, pcap_cb):
-            pass
+            icmp = decode_frames(frames)
+            batch.extend(table.match(icmp['seq'], icmp['slot'], np.array(times),
+                                     icmp['type'] == 8, icmp['type'] == 0))
+            del times[:], frames[:]
     except KeyboardInterrupt:
         pass
+    table.pprint()
 
     # timeout_ms was reached, notify parser that we are done
-    data_pipe.send('RCV_DONE')
+    batch.close()
+    DEBUG('DONE', __name__)
+
+
+###############################################################################
+def ringloop(data_pipe, ns, geotimes=None):
+    """receive ICMP packets on a memory-mapped AF_PACKET ring (see
+    rxring) and match the replies to the captured requests one block
+    of frames at a time"""
+    import rxring
+
+    hphelper.set_affinity('rcvloop')
+
+    DEBUG('starting ring receiver ', __name__)
+
+    # send times of the outstanding requests
+    table = send_table(options.seq_window)
+
+    batch = hphelper.batch_writer(data_pipe)
+
+    try:
+        ring = rxring.packet_ring(options.eth, options.IPDST)
+    except (socket.error, EnvironmentError) as e:
+        print e
+        raise SystemExit(-1)
+
+    # notify sender that we are ready to capture
+    ns.RCV_READY = True
+    # block until sender says it is ready
+    ns.wait_ready(rcv=False)
+
+    DEBUG('READY', __name__)
+    try:
+        for (icmp_type, seq, slot, ts, outgoing) in ring.blocks(timeout_ms=3000):
+            batch.extend(table.match(seq, slot, ts,
+                                     (icmp_type == 8) & outgoing,       # ICMP echo request
+                                     (icmp_type == 0) & ~outgoing))     # ICMP echo reply
+    except KeyboardInterrupt:
+        pass
+
+    ring.close()
+    ring.pprint()
+    table.pprint()
+
+    # timeout was reached, notify parser that we are done
+    batch.close()
     DEBUG('DONE', __name__)
 
 
@@ -98,69 +244,169 @@ def dumploop(pipe, ns, geotimes=None):
     # notify sender that we are ready to capture
     ns.RCV_READY = True
     # block until sender says it is ready
-    while not ns.SND_READY:
-        time.sleep(0.1)
+    ns.wait_ready(rcv=False)
 
     DEBUG('READY', __name__)
 
+    batch = hphelper.batch_writer(pipe)
     try:
-        for s in dump.rcv_order[:pnum]:
-            if s == -1:
-                continue
-            seq = s
-            slot = dump.slottimes[seq]
-            rtt = dump.rtts[seq]
-            pipe.send((seq, slot, rtt))      # send to parser process 
-    except IndexError:
-        print s
-        print seq
+        seq = dump.rcv_order[:pnum]
+        seq = seq[seq != -1]
+        recs = np.empty(len(seq), dtype=hphelper.PROBE_DTYPE)
+        recs['seq'] = seq
+        recs['slot'] = dump.slottimes[seq]
+        recs['rtt'] = dump.rtts[seq]
+        batch.extend(recs)                   # send to parser process 
     except KeyboardInterrupt:
-        print s
         print 'canceled reading file.'
 
     # notify parser that we are done
-    pipe.send('RCV_DONE')
+    batch.close()
     #q.close()
     DEBUG('done ',  __name__)
 
 
 
+def test_decode(n=10**5, size=256):
+    """Measures the per packet time of the capture callback and the
+    decoding for n echo requests followed by their replies, delivered
+    in pcap buffers of size packets: the former per packet decoding
+    (struct.unpack and probe_batch.append) against collecting the
+    frames and decoding each buffer with decode_frames and
+    send_table.match. Both must produce the same records. The frames
+    are passed to the callbacks as buffer objects, as pypcap does."""
+    class null_pipe(object):
+        def __init__(self): self.recs = []
+        def send_bytes(self, data): self.recs.append(np.frombuffer(data, dtype=hphelper.PROBE_DTYPE))
+
+    pkts = []
+    for seq in xrange(n):
+        pkts.append((1.0+seq*1e-3, '\0'*34 + '\x08' + '\0'*15 + struct.pack('!LL', seq, 2*seq) + '\0'*22))
+    for seq in xrange(n):
+        pkts.append((1.5+seq*1e-3, '\0'*34 + '\x00' + '\0'*15 + struct.pack('!LL', seq, 2*seq) + '\0'*22))
+    pkts.sort()                                             # replies follow their requests
+    bufs = [pkts[i:i+size] for i in xrange(0, len(pkts), size)]
+
+    # per packet decoding
+    s_times = -1.0*np.ones(n)
+    pipe = null_pipe()
+    batch = hphelper.probe_batch(pipe)
+    batch_append = batch.append
+    struct_unpack = struct.unpack
+    def pcap_cb(time, pkt):
+        (icmp_type,) = struct_unpack('!B',pkt[34:34+1])
+        (seq,slot) = struct_unpack('!LL',pkt[50:58])
+        if icmp_type==8:
+            s_times[seq] = time
+        elif icmp_type==0:
+            batch_append(seq, slot, time-s_times[seq])
+    t = time.time()
+    for buf in bufs:
+        for (ts, pkt) in buf:
+            pcap_cb(ts, pkt)
+        batch.flush()
+    t_old = time.time()-t
+    ref = np.concatenate(pipe.recs)
+
+    # batch decoding
+    table = send_table(n)
+    pipe = null_pipe()
+    batch = hphelper.probe_batch(pipe)
+    times = []
+    frames = []
+    itemsize = ICMP_DTYPE.itemsize
+    def pcap_cb(time, pkt):
+        times.append(time)
+        frames.append(str(pkt[:itemsize]))
+    t = time.time()
+    for buf in bufs:
+        # pypcap may deliver buffer objects into its capture buffer
+        for (ts, pkt) in buf:
+            pcap_cb(ts, buffer(pkt))
+        icmp = decode_frames(frames)
+        batch.extend(table.match(icmp['seq'], icmp['slot'], np.array(times),
+                                 icmp['type'] == 8, icmp['type'] == 0))
+        del times[:], frames[:]
+    t_new = time.time()-t
+    recs = np.concatenate(pipe.recs)
+
+    if not np.all(recs == ref):
+        ERROR('batch decoding differs from per packet decoding')
+    INFO('records identical', len(recs))
+    INFO('per packet decoding', '%.2f us/packet' % (t_old/len(pkts)*1e6))
+    INFO('batch decoding', '%.2f us/packet' % (t_new/len(pkts)*1e6))
+
+
+
+def test_send_table(n=10**6, window=2**12, size=1000, rtt=500):
+    """Feeds n requests and their replies, which arrive about rtt
+    sequence numbers later, through a send_table in batches of size
+    packets. 1% of the replies are lost, 1% are duplicated and 1% are
+    delayed by more than the window. Checks the matched records and
+    the loss, late and duplicate counts."""
+    np.random.seed(1)
+    seq = np.arange(n)
+    lost = np.random.rand(n) < 0.01
+    late = ~lost & (np.random.rand(n) < 0.01)
+    dup = ~lost & ~late & (np.random.rand(n) < 0.01)
+    delay = rtt + np.random.randint(-rtt//2, rtt//2, n) + late*(window+rtt)
+    ev_seq = np.concatenate((seq, seq[~lost], seq[dup]))
+    ev_time = np.concatenate((seq, (seq+delay)[~lost], (seq+delay)[dup]+1)).astype(float)
+    ev_req = np.concatenate((np.ones(n, bool), np.zeros(np.sum(~lost)+np.sum(dup), bool)))
+    order = np.argsort(ev_time, kind='mergesort')
+    (ev_seq, ev_time, ev_req) = (ev_seq[order], ev_time[order], ev_req[order])
+
+    table = send_table(window)
+    t = time.time()
+    recs = [table.match(ev_seq[i:i+size], ev_seq[i:i+size], ev_time[i:i+size],
+                        ev_req[i:i+size], ~ev_req[i:i+size]) for i in xrange(0, len(ev_seq), size)]
+    t = time.time()-t
+    recs = np.concatenate(recs)
+
+    late &= seq + window < n            # the last requests never expire
+    ok = ~lost & ~late
+    if not (np.all(np.sort(recs['seq']) == seq[ok]) and np.all(recs['rtt'] == delay[recs['seq']])):
+        ERROR('send table records differ')
+    if table.late != np.sum(late) or table.duplicate != np.sum(dup):
+        ERROR('send table counts differ')
+    INFO('records matched', len(recs))
+    table.pprint()
+    INFO('matching', '%.2f us/packet' % (t/len(ev_seq)*1e6))
+
+
+
 class dumpdata(object):
     """ Store the data loaded from a dumped trace file. """
-    def __init__(self, options):
-        self.slottimes = -1*np.ones(options.pnum).astype(int)
-        self.rcv_order = -1*np.ones(options.pnum).astype(int)
-        self.rtts = np.zeros(options.pnum)  
+    def __init__(self, options, size=None):
+        if size is None:
+            size = options.pnum
+        self.slottimes = -1*np.ones(size).astype(int)
+        self.rcv_order = -1*np.ones(size).astype(int)
+        self.rtts = np.zeros(size)  
         self.dump_options = None
 
     def pprint(self):
         print 'loaded %d samples (dump mean %.6f)\n' % (np.sum(self.rcv_order!=-1), np.mean(self.rtts))
 
+    def xcov(self, max_lag=None, min_rtt=None):
+        """Returns an XcovEst holding the covariance of the busy/idle
+        slot series of the dump (see parser_xcov.xcov_fft). A probe is
+        busy if its RTT exceeds min_rtt; max_lag and min_rtt default
+        to options.L and options.min_rtt."""
+        import offline
+        import parser_xcov
+        if max_lag is None:
+            max_lag = options.L
+        (seq, slot, rtt) = offline.dump_records(self)
+        ok = offline.in_order(seq)
+        (probes, zcounts) = offline.probe_series(slot[ok], rtt[ok], min_rtt)
+        return parser_xcov.xcov_fft(probes, zcounts, max_lag)
 
 
-def dump_loader():
-    print "loading %d RTTs from " %(options.pnum) + options.loaddump 
-    dump = dumpdata(options)
-
-    try:
-        if options.loaddump[-2:].lower()=='gz':
-            fs = gzip.open(options.loaddump, mode='r')
-        else:
-            fs = open(options.loaddump, mode='r')
-        # first line should be a comment containing options
-        l = fs.readline() 
-        (c, STR, opt) = str.split(l,' ',2)
-    except IOError as e:
-        print 'error reading dump file'
-        print e
-        raise SystemExit(1)
-    except Exception as e:
-        print 'error parsing dump file'
-        raise SystemExit(1)
 
+def set_dump_options(dump):
+    """Set some options loaded from the dump file"""
     try:
-        dump.dump_options = eval(opt)
-        # set some options loaded from the dump file
         options.IPDST = dump.dump_options['IPDST']
         options.DST = dump.dump_options['DST']
         options.plen = dump.dump_options['plen']
@@ -169,30 +415,46 @@ def dump_loader():
         options.start_time = dump.dump_options['start_time']
     except KeyError as ke:
         pass
-    except SyntaxError as se:
-        print 'could not parse options'
 
 
-    line_count = 0
+
+def dump_loader():
+    """Load a binary or text dump file. Binary dumps are
+    memory-mapped, text dumps are parsed in vectorized chunks. The
+    dumpdata arrays are sized from the file and options.pnum is set
+    accordingly."""
+    print "loading RTTs from " + options.loaddump 
+
+    t = time.time()
     try:
-        while (line_count < options.pnum):  
-            try:
-                l = fs.readline()
-                (s, snd_slot, rtt) = str.split(l)
-                seq = int(s)
-                dump.slottimes[seq] = int(snd_slot)
-                dump.rtts[seq] = float(rtt)
-                dump.rcv_order[line_count] = seq
-            except ValueError:
-                break
-            except IndexError:
-                # specified options.pnum is too small 
-                break
-            line_count += 1
+        if dumpwriter.is_bin_dump(options.loaddump):
+            (opts, recs) = dumpwriter.load_bin_dump(options.loaddump)
+        else:
+            (opts, recs) = dumpwriter.read_text_dump(options.loaddump)
+    except (IOError, ValueError) as e:
+        print 'error reading dump file'
+        print e
+        raise SystemExit(1)
     except KeyboardInterrupt:
-        pass # canceled reading file
+        print 'canceled reading file.'
+        raise SystemExit(1)
+    t = time.time() - t
+    INFO('parse throughput', '%d records in %.2f s (%.0f records/s)' % (len(recs), t, len(recs)/max(t, 1e-9)))
+
+    seq = recs['seq']
+    dump = dumpdata(options, int(seq.max())+1 if len(seq) else 0)
+    options.pnum = len(dump.slottimes)
+
+    dump.dump_options = opts
+    if opts is None:
+        print 'could not parse options'
+    else:
+        set_dump_options(dump)
+
+    dump.rcv_order = seq
+    dump.slottimes[seq] = recs['slot']
+    dump.rtts[seq] = recs['rtt']
 
-    fs.close()
     dump.pprint()
 
     if options.min_rtt==-1:
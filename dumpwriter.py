@@ -1,10 +1,16 @@
 import os
 import sys
+import gzip
+import json
+import zlib
+import Queue
 import pprint
+import struct
 import logging
 import threading
 import time
 
+import numpy as np
 
 import hphelper
 
@@ -13,8 +19,207 @@ options = hphelper.options
 DEBUG = hphelper.DEBUG
 
 
+# binary dump format: BIN_MAGIC, the length of the JSON header as a
+# little endian uint32, the JSON header (space padded so that the
+# records start at a multiple of BIN_ALIGN bytes), followed by the
+# packed PROBE_DTYPE (seq, slot, rtt) records in receive order
+BIN_MAGIC = 'HPDUMP1\n'
+BIN_ALIGN = 16
+
+
+def bin_header(opts):
+    """Returns the header of a binary dump file. opts is either an
+    options object or a dict; only JSON serializable options are
+    stored."""
+    if not isinstance(opts, dict):
+        opts = vars(opts)
+    d = {}
+    for k,v in opts.iteritems():
+        if k.startswith('__'): continue
+        try:
+            json.dumps(v)
+            d[k] = v
+        except (TypeError, ValueError):
+            pass
+
+    hdr = json.dumps({'options':d, 'dtype':hphelper.PROBE_DTYPE.descr})
+    hdr += ' '*(-(len(BIN_MAGIC)+4+len(hdr)) % BIN_ALIGN)
+    return BIN_MAGIC + struct.pack('<I', len(hdr)) + hdr
+
+
+def is_bin_dump(fname):
+    """Returns True if fname is a binary dump file"""
+    try:
+        fs = open(fname, 'rb')
+        magic = fs.read(len(BIN_MAGIC))
+        fs.close()
+    except IOError:
+        return False
+    return magic == BIN_MAGIC
+
+
+def load_bin_dump(fname):
+    """Memory-maps a binary dump file. Returns the dict of options
+    stored in the header and an array of (seq, slot, rtt) records."""
+    fs = open(fname, 'rb')
+    if fs.read(len(BIN_MAGIC)) != BIN_MAGIC:
+        raise ValueError('not a binary dump file: ' + fname)
+    (n,) = struct.unpack('<I', fs.read(4))
+    hdr = json.loads(fs.read(n))
+    fs.close()
+
+    dtype = np.dtype([(str(name), str(t)) for (name, t) in hdr['dtype']])
+    offset = len(BIN_MAGIC) + 4 + n
+    if os.path.getsize(fname) - offset < dtype.itemsize:
+        recs = np.empty(0, dtype=dtype)
+    else:
+        recs = np.memmap(fname, dtype=dtype, mode='r', offset=offset)
+    opts = {}
+    for (k,v) in hdr['options'].iteritems():
+        opts[str(k)] = str(v) if isinstance(v, unicode) else v
+    return (opts, recs)
+
+
+def _bg_reader(fs, chunk_size, depth=4):
+    # read chunks from fs in a background thread so that reading (and
+    # decompressing) overlaps the parsing of the previous chunks. The
+    # reader stops when the generator is closed early.
+    q = Queue.Queue(depth)
+    stop = threading.Event()
+    def reader():
+        try:
+            while not stop.is_set():
+                chunk = fs.read(chunk_size)
+                q.put(chunk)
+                if not chunk: break
+        except (IOError, EOFError, zlib.error) as e:
+            print 'error reading dump file'
+            print e
+            q.put('')
+
+    t = threading.Thread(target=reader)
+    t.daemon = True
+    t.start()
+    try:
+        while 1:
+            chunk = q.get()
+            if not chunk: break
+            yield chunk
+    finally:
+        stop.set()
+        # unblock the reader if the queue is full
+        while t.is_alive():
+            try:
+                q.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def _parse_lines(text):
+    # convert a block of complete "seq slot rtt" lines into records.
+    # Returns the records and False if the block contained a line
+    # which could not be parsed (parsing stops there).
+    c = np.frombuffer(text, dtype=np.uint8)
+    nl = np.flatnonzero(c == 10)
+    if len(nl):
+        # count the fields of each line: the non-blank characters
+        # which follow a blank one (control characters count as blank,
+        # fields containing them fail to parse below)
+        space = c <= 32
+        starts = ~space & np.r_[True, space[:-1]]
+        fields = np.add.reduceat(starts.view(np.uint8), np.r_[0, nl[:-1]+1], dtype=np.int32)
+    else:
+        fields = np.zeros(0, dtype=np.int32)
+    bad = np.flatnonzero(fields != 3)
+    n = bad[0] if len(bad) else len(nl)
+    end = nl[n-1]+1 if n else 0
+    vals = np.fromstring(text[:end], sep=' ')
+    if len(vals) != 3*n:
+        # a field which is not a number: find its line
+        lines = text[:end].split('\n')
+        for n in xrange(len(lines)):
+            try:
+                map(float, lines[n].split())
+            except ValueError:
+                break
+        vals = np.array(' '.join(lines[:n]).split(), dtype=float)
+        bad = [n]
+    recs = np.empty(n, dtype=hphelper.PROBE_DTYPE)
+    recs['seq'] = vals[0::3]
+    recs['slot'] = vals[1::3]
+    recs['rtt'] = vals[2::3]
+    return (recs, not len(bad))
+
+
+def read_text_dump(fname, chunk_size=2**22):
+    """Reads a text dump (optionally gzipped) in chunks of chunk_size
+    bytes and converts each block of lines into NumPy columns. Gzipped
+    files are decompressed in a background thread. Parsing stops at
+    the first malformed line. Returns the dict of options from the
+    header line (None if it could not be parsed) and an array of
+    PROBE_DTYPE records."""
+    if fname[-2:].lower()=='gz':
+        fs = gzip.open(fname, mode='rb')
+        chunks = _bg_reader(fs, chunk_size)
+    else:
+        fs = open(fname, mode='rb')
+        chunks = iter(lambda: fs.read(chunk_size), '')
+
+    # first line should be a comment containing options
+    opts = None
+    rest = fs.readline()
+    if rest[:1] == '%':
+        try:
+            opts = eval(str.split(rest,' ',2)[2])
+        except Exception:
+            pass
+        rest = ''
+
+    blocks = []
+    ok = True
+    for chunk in chunks:
+        text = rest + chunk
+        end = text.rfind('\n')+1
+        rest = text[end:]
+        (recs, ok) = _parse_lines(text[:end])
+        blocks.append(recs)
+        if not ok: break
+    if ok and rest.strip():
+        blocks.append(_parse_lines(rest + '\n')[0])
+    if hasattr(chunks, 'close'):
+        chunks.close()                  # stops the background reader
+    fs.close()
+
+    if not blocks:
+        return (opts, np.empty(0, dtype=hphelper.PROBE_DTYPE))
+    return (opts, np.concatenate(blocks))
+
+
+def convert_dump(src, dst):
+    """Converts a text dump (optionally gzipped) into a binary dump
+    or a binary dump into a text dump."""
+    if is_bin_dump(src):
+        (opts, recs) = load_bin_dump(src)
+        fs = open(dst, mode='w')
+        fs.write('% ' + 'options:' + ' ' + str(opts) + '\n')
+        for i in xrange(0, len(recs), 10**5):
+            fs.write(''.join(["%d %d %.9f\n" % r for r in recs[i:i+10**5].tolist()]))
+        fs.close()
+        return
+
+    (opts, recs) = read_text_dump(src)
+    if opts is None:
+        print 'could not parse options'
+        opts = {}
+
+    fs = open(dst, mode='wb')
+    fs.write(bin_header(opts))
+    fs.write(recs.tostring())
+    fs.close()
+
+
 def dumpwriter(pipe, ns, ST=None):
-    hphelper.set_affinity('parser') 
+    hphelper.set_affinity('dumpwriter', 'parser')
     DEBUG('starting',  __name__)
 
     stats = hphelper.stats_stats()
@@ -22,41 +227,43 @@ def dumpwriter(pipe, ns, ST=None):
     # start progress bar thread
     hphelper.bar_init(options, stats)
 
-    if not options.start_time:
-        options.start_time = time.time()
-  
-    if not options.savefile:
-        # default save name is destination + YYMMDD + HHMM
-        options.savefile = options.DST + time.strftime("_%Y%m%d_%H%M", 
-                                                       time.localtime(options.start_time)) 
-
-    options.savefile += options.tag 
-    options.savefile += '.dump'
+    binary = options.dump_format == 'binary'
+    if binary:
+        hphelper.init_savefile('.bdump', raw=True)
+    else:
+        hphelper.init_savefile('.dump', raw=True)
 
     print "saving RTTs to " + options.savefile + " ..."
 
     try:
+        if binary:
+            fs = open(options.savefile, mode='wb')
+            fs.write(bin_header(options))                                  # save options
+        else:
             fs = open(options.savefile, mode='w')
             fs.write('% ' + 'options:' + ' ' + str(options) + '\n')    # save options
     except KeyboardInterrupt:
             print 'canceled writing file.'
 
     #block until sender + receiver say they are ready
-    while not all([ns.RCV_READY,ns.SND_READY]):
-        time.sleep(0.1)
+    ns.wait_ready()
 
 
     stats.run_start = time.time()
     try:
        while 1:
-            (seq, slot, rtt) = pipe.recv()
-            if seq == -2: break
+            recs = hphelper.recv_batch(pipe)
+            if recs is None: break
 
-            stats.update(seq, rtt=rtt, current_slot=slot)
+            stats.update_batch(recs['seq'], recs['rtt'], recs['slot'])
 
-            fs.write("%d %d %.9f\n" % (seq, slot , rtt))
-    except (ValueError, KeyboardInterrupt) as e:
-        print 
+            if binary:
+                fs.write(recs.tostring())
+            else:
+                fs.write(''.join(["%d %d %.9f\n" % r for r in recs.tolist()]))
+    except (KeyboardInterrupt) as e:
+        pass
+    print 
 
     fs.close()
     DEBUG('done',  __name__)
@@ -66,7 +273,9 @@ def dumpwriter(pipe, ns, ST=None):
 
 
 
-
-
-
-
+if __name__ == '__main__':
+    try:
+        convert_dump(sys.argv[1], sys.argv[2])
+    except IndexError:
+        print 'usage: python dumpwriter.py src dst'
+        print 'convert a text dump (.dump or .dump.gz) into a binary dump (.bdump) or vice versa'
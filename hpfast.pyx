@@ -18,16 +18,26 @@ arange = np.arange
 
 DTYPE = np.uint8
 ctypedef np.uint8_t DTYPE_t
+ctypedef np.int_t DINT_t
+ctypedef np.float64_t DDOUBLE_t
 
 
 cdef inline int int_max(int a, int b): return a if a >= b else b
 cdef inline int int_min(int a, int b): return a if a <= b else b
 
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+
+def monotonic():
+    """ seconds of the monotonic clock (used for pacing the probes) """
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec*1e-9
+
 def min(int a, int b): 
     return a if a <= b else b
 
 def max(int a, int b): 
-    return a if a <= b else b
+    return a if a >= b else b
 
 
 print 'loading cython modules ...'
@@ -71,6 +81,30 @@ cdef class var_est(object):
         self.M2 += delta*(x - self.mean)
 
 
+    def step_n(self, double x, long k):
+        if k<1: return
+        cdef long n = self.n + k
+        cdef double delta = x - self.mean
+        self.mean += delta*k/n
+        self.M2 += delta*delta*self.n*k/n
+        self.n = n
+
+
+    def state(self):
+        return (self.n, self.mean, self.M2)
+
+
+    def merge(self, var_est other):
+        # parallel variance algorithm by Chan et al.
+        cdef long n = self.n + other.n
+        if not n: return self
+        cdef double delta = other.mean - self.mean
+        self.mean = (self.n*self.mean + other.n*other.mean)/n
+        self.M2 += other.M2 + delta*delta*self.n*other.n/n
+        self.n = n
+        return self
+
+
     def var(self):
         # return NaN if less than 100 samples exist
         if self.n<100: return np.nan
@@ -79,34 +113,52 @@ cdef class var_est(object):
 
 #cimport cython
 #@cython.boundscheck(False) # turn off bounds-checking for entire function
+cdef inline void bank_step(long[:] n, double[:] mean, double[:] M2, int i, double x, long k):
+        # add k samples x to level i of a variance bank
+        cdef long n_a = n[i]
+        cdef double delta = x - mean[i]
+        n[i] = n_a + k
+        mean[i] += delta*k/n[i]
+        M2[i] += delta*delta*n_a*k/n[i]
+
+
 def av_append_f(self, int probe, int zcount=0):
-        ''' Append the latest received probe to a sliding
-        window. Update the aggregate variances for each variance
-        block '''
-        cdef np.ndarray[DTYPE_t, ndim=1] win = self.win.astype(DTYPE)
-        cdef int probe_count = <int>self.probe_count
-        cdef int slot_count = <int>self.slot_count
-
-        cdef int m
+        ''' Append the latest received probe after zcount empty
+        slots and update the running block sums and the variance bank
+        of all aggregation levels '''
+        cdef np.ndarray[DINT_t, ndim=1] levels = self._levels
+        cdef np.ndarray[DDOUBLE_t, ndim=1] bsum = self._bsum
+        cdef long[:] n = self.avars.n
+        cdef double[:] mean = self.avars.mean
+        cdef double[:] M2 = self.avars.M2
+        cdef long slot_count = self.slot_count
+        cdef long m, nb
         cdef int i
 
-        probe_count += probe     
-        for i in xrange(zcount+1):
-            win = np.append(win[1:], np.uint8(probe if i==zcount else 0))
-            slot_count += 1
+        self.probe_count += probe
 
-            for m,var in self.avars.iteritems():
-                if not slot_count % m:
-                    var.step(np.mean(win[-m:])) 
+        for i in xrange(levels.shape[0]):
+            m = levels[i]
+            if zcount:
+                # blocks which end within the empty slots
+                nb = (slot_count+zcount)//m - slot_count//m
+                if nb:
+                    bank_step(n, mean, M2, i, bsum[i]/m, 1)
+                    if nb>1:
+                        bank_step(n, mean, M2, i, 0.0, nb-1)
+                    bsum[i] = 0.0
 
-        self.win = win.astype(bool)
-        self.slot_count = slot_count
-        self.probe_count = probe_count
+            bsum[i] += probe
+            if (slot_count+zcount+1) % m == 0:
+                bank_step(n, mean, M2, i, bsum[i]/m, 1)
+                bsum[i] = 0.0
+
+        self.slot_count = slot_count+zcount+1
 
 
 
 def get_avars_corrected_f(self):
-    cdef float var_w = <float>self.avars[1].var()
+    cdef float var_w = <float>self.bank().var()[0]
     cdef float var_a = <float>self.var_a
     cdef float mean_a = <float>self.mean_a
 
@@ -122,19 +174,34 @@ def get_avars_corrected_f(self):
 ########################################################################
 # parser_xcov.py
 def xc_append_f(self, int x, int zcount = 0):
+        cdef int L = self.L
+        cdef int head = self._head
+        cdef int i
+        cdef np.ndarray[DTYPE_t, ndim=1] win = self._win.view(DTYPE)
+        cdef np.ndarray[DINT_t, ndim=1] xc = self._xc
 
         self.slot_count  += zcount+1                    # keep track of total number or counted slots (should be all)
         self.probe_count += x                           # increment counter for each was received probe (zero or one)
 
-        zcount = int_min(self.L-1, zcount)
-
-        # shift window to the left (concatenate is faster than roll for shifting)
-        self.win = concatenate( (self.win[zcount+1:], zeros(zcount, dtype=bool), [bool(x)]) )           
+        zcount = int_min(L-1, zcount)
 
+        # clear the skipped slots of the circular buffer and advance the head
+        for i in xrange(zcount):
+            head += 1
+            if head == L: head = 0
+            win[head] = 0
+        head += 1
+        if head == L: head = 0
+        win[head] = x
+        self._head = head
 
         # increment autocovariance (just for non-zero values of win and only if x=1)
         if x==1:
-            self.xc[nonzero(self.win)] += x
+            for i in xrange(L):
+                if win[i]:
+                    xc[(L-1-head+i) % L] += 1
+            if self.slot_count <= L:
+                self._lead.append(self.slot_count-1)
 
 
 
@@ -3,13 +3,84 @@
 # Zdravko Bozakov (zb@ikt.uni-hannover.de)
 
 import time
+import ctypes
 import threading
+import multiprocessing
 import numpy as np
 import os 
 
 class options:
     DEBUG = False
     loaddump = False
+    progress = True
+    continuous = False
+    track = False
+    horizon = 0
+    epochs = 8
+    checkpoint = 0
+    resume = ''
+    seq0 = 0
+    slot0 = 0
+
+
+def _event_property(name, doc):
+    # expose a multiprocessing.Event as a boolean attribute
+    def fget(self):
+        return getattr(self, name).is_set()
+    def fset(self, value):
+        if value:
+            getattr(self, name).set()
+        else:
+            getattr(self, name).clear()
+    return property(fget, fset, doc=doc)
+
+
+class ctrl_block(object):
+    """A control block shared by the sender, capture and parser
+    processes. The ready handshake and the error flag are events and
+    the run parameters are typed shared values, so no manager process
+    is needed and waiting processes wake up as soon as a flag is set.
+    Must be created before the processes are forked.
+    """
+
+    SND_READY   = _event_property('_snd_ready', 'sender is ready to send')
+    RCV_READY   = _event_property('_rcv_ready', 'receiver is ready to capture')
+    CAP_READY   = _event_property('_cap_ready', 'capture is ready')
+    FATAL_ERROR = _event_property('_fatal', 'a process failed, all processes should terminate')
+
+    def __init__(self):
+        self._snd_ready = multiprocessing.Event()
+        self._rcv_ready = multiprocessing.Event()
+        self._cap_ready = multiprocessing.Event()
+        self._fatal = multiprocessing.Event()
+        self._cnum = multiprocessing.RawValue(ctypes.c_long, 0)
+        self._mean_rtt = multiprocessing.RawValue(ctypes.c_double, np.nan)
+
+    @property
+    def cnum(self):
+        """number of calibration probes or None for a measurement run"""
+        return self._cnum.value or None
+
+    @cnum.setter
+    def cnum(self, value):
+        self._cnum.value = value or 0
+
+    @property
+    def mean_rtt(self):
+        """mean RTT measured by the calibration run or None"""
+        if np.isnan(self._mean_rtt.value): return None
+        return self._mean_rtt.value
+
+    @mean_rtt.setter
+    def mean_rtt(self, value):
+        self._mean_rtt.value = np.nan if value is None else value
+
+    def wait_ready(self, snd=True, rcv=True):
+        """Block until the sender and/or the receiver are ready. Exits
+        if another process signalled a fatal error."""
+        for (wait, ev) in ((snd, self._snd_ready), (rcv, self._rcv_ready)):
+            while wait and not ev.wait(0.5):
+                if self.FATAL_ERROR: raise SystemExit(1)
 
 
 class txt_color:
@@ -44,6 +115,7 @@ class stats_stats:
 
     def __init__(self):
         self.seq = 0
+        self.extra_stats = {}
 
     def runtime(self):
         return (self.run_end - self.run_start)
@@ -59,6 +131,14 @@ class stats_stats:
         self.sum_rtt += rtt
         self.rx_slots = current_slot
 
+    def update_batch(self, seqs, rtts, slots):
+        """Update the statistics with arrays of probe records"""
+        if not len(seqs): return
+        self.seq = seqs[-1]
+        self.rx_total += len(seqs)
+        self.sum_rtt += np.sum(rtts)
+        self.rx_slots = slots[-1]
+
         
     def mean_a(self):
         if self.rx_slots:
@@ -69,6 +149,17 @@ class stats_stats:
         return 1.0*self.sum_rtt/self.rx_total
 
 
+    STATE = ('rx_total', 'rcv_err', 'rx_out_of_order', 'sum_rtt', 'min_rtt', 'max_rtt')
+
+    def state(self):
+        """Returns the counters which are saved in checkpoints"""
+        return dict([('stats_' + k, getattr(self, k)) for k in self.STATE])
+
+    def load_state(self, state):
+        for k in self.STATE:
+            setattr(self, k, np.asarray(state['stats_' + k]).item())
+
+
     def append_stats(self, **kwargs):
         for k,v in kwargs.iteritems():
             self.extra_stats[k]=v
@@ -124,6 +215,528 @@ class fixed_buf(object):
                 raise IndexError
 
 
+# record format of the probe batches sent from the capture process
+# to the parser process
+PROBE_DTYPE = np.dtype([('seq','<u4'), ('slot','<u4'), ('rtt','<f8')])
+
+
+class probe_batch(object):
+    """Collects (seq, slot, rtt) probe records in a fixed size array
+    and sends them over a pipe as a single buffer. The batch is sent
+    when it is full or when the last batch was sent more than timeout
+    seconds ago.
+    """
+
+    def __init__(self, pipe, size=1024, timeout=0.05):
+        self.pipe = pipe
+        self.size = size
+        self.timeout = timeout
+        self.buf = np.empty(size, dtype=PROBE_DTYPE)
+        self.n = 0
+        self.t_flush = time.time()
+
+    def append(self, seq, slot, rtt):
+        n = self.n
+        self.buf[n] = (seq, slot, rtt)
+        self.n = n+1
+        if self.n == self.size or time.time()-self.t_flush > self.timeout:
+            self.flush()
+
+    def extend(self, recs):
+        """Send an array of PROBE_DTYPE records after the pending ones"""
+        self.flush()
+        for i in xrange(0, len(recs), self.size):
+            self._send(recs[i:i+self.size])
+
+    def flush(self):
+        if self.n:
+            self._send(self.buf[:self.n])
+            self.n = 0
+        self.t_flush = time.time()
+
+    def _send(self, recs):
+        self.pipe.send_bytes(recs.tostring())
+
+    def close(self):
+        """Send the pending records followed by an empty batch which
+        notifies the parser that we are done"""
+        self.flush()
+        self.pipe.send_bytes('')
+
+
+class shm_ring(object):
+    """A single-producer/single-consumer ring buffer of PROBE_DTYPE
+    records in shared memory, used as an alternative to the pipe
+    between the capture and the parser process.
+
+    The ring must be created before the processes are forked. The
+    head (records written), tail (records read) and closed counters
+    are visible to both sides, so the consumer can tell how far it
+    lags behind (see lag). Only the producer writes head and only the
+    consumer writes tail. The producer publishes head every publish
+    records, after timeout seconds, and on flush(). A full ring blocks
+    the producer, an empty ring blocks the consumer, both by polling
+    every poll seconds.
+
+    The writer methods match probe_batch and recv_batch matches the
+    module function of the same name.
+    """
+
+    HEAD, TAIL, CLOSED = 0, 1, 2
+
+    def __init__(self, size=2**18, publish=64, timeout=0.05, poll=1e-3):
+        self.size = size
+        self.publish = publish
+        self.timeout = timeout
+        self.poll = poll
+        self._shm = multiprocessing.RawArray(ctypes.c_char, size*PROBE_DTYPE.itemsize)
+        self.ctr = multiprocessing.RawArray(ctypes.c_uint64, 3)
+        self.recs = np.frombuffer(self._shm, dtype=PROBE_DTYPE)
+        self.open_writer()
+
+    @property
+    def lag(self):
+        """Number of records written but not yet read"""
+        return int(self.ctr[self.HEAD] - self.ctr[self.TAIL])
+
+    def open_writer(self):
+        """Synchronize the producer's copy of the counters. Must be
+        called by the producer process before writing."""
+        self._head = int(self.ctr[self.HEAD])  # producer's unpublished head
+        self._pub = self._head                 # producer's last published head
+        self._tail = int(self.ctr[self.TAIL])  # producer's last known tail
+        self.t_flush = time.time()
+        return self
+
+    def _wait_free(self, n):
+        # block until n records can be written
+        while self._head + n - self._tail > self.size:
+            self.flush()
+            self._tail = int(self.ctr[self.TAIL])
+            if self._head + n - self._tail > self.size:
+                time.sleep(self.poll)
+
+    def append(self, seq, slot, rtt):
+        head = self._head
+        if head - self._tail >= self.size:
+            self._wait_free(1)
+        self.recs[head % self.size] = (seq, slot, rtt)
+        self._head = head = head+1
+        if head - self._pub >= self.publish or time.time() - self.t_flush > self.timeout:
+            self.flush()
+
+    def extend(self, recs):
+        """Write an array of PROBE_DTYPE records"""
+        size = self.size
+        for j in xrange(0, len(recs), size):
+            chunk = recs[j:j+size]
+            n = len(chunk)
+            self._wait_free(n)
+            i = self._head % size
+            k = min(n, size-i)
+            self.recs[i:i+k] = chunk[:k]
+            self.recs[:n-k] = chunk[k:]
+            self._head += n
+            self.flush()
+
+    def flush(self):
+        """Publish the written records"""
+        self.ctr[self.HEAD] = self._pub = self._head
+        self.t_flush = time.time()
+
+    def close(self):
+        """Notify the consumer that no more records will be written"""
+        self.flush()
+        self.ctr[self.CLOSED] = 1
+
+    def recv_batch(self):
+        """Blocks until records are available and returns a copy of
+        all unread records. Returns None once the ring was closed and
+        all records were read, and rearms the ring for the next run."""
+        ctr = self.ctr
+        while 1:
+            tail = ctr[self.TAIL]
+            head = ctr[self.HEAD]
+            if head != tail: break
+            if ctr[self.CLOSED]:
+                # head is published before the closed flag
+                if ctr[self.HEAD] == tail:
+                    ctr[self.CLOSED] = 0
+                    return None
+                continue
+            time.sleep(self.poll)
+
+        size = self.size
+        n = min(head - tail, size)
+        i = tail % size
+        if i+n <= size:
+            recs = self.recs[i:i+n].copy()
+        else:
+            recs = np.concatenate((self.recs[i:], self.recs[:i+n-size]))
+        ctr[self.TAIL] = tail+n                 # release the slots
+        return recs
+
+
+class fanout(probe_batch):
+    """Collects probe records like probe_batch and sends each batch
+    through several writers, one for each parser process."""
+
+    def __init__(self, writers, size=1024, timeout=0.05):
+        probe_batch.__init__(self, None, size, timeout)
+        self.writers = writers
+
+    def _send(self, recs):
+        for w in self.writers:
+            w.extend(recs)
+
+    def close(self):
+        self.flush()
+        for w in self.writers:
+            w.close()
+
+
+def batch_writer(pipe):
+    """Returns the object used to send probe records over pipe, which
+    is either a pipe connection, a shm_ring or a list of these."""
+    if isinstance(pipe, (list, tuple)):
+        if len(pipe) == 1:
+            return batch_writer(pipe[0])
+        return fanout([batch_writer(p) for p in pipe])
+    if isinstance(pipe, shm_ring):
+        return pipe.open_writer()
+    return probe_batch(pipe)
+
+
+def recv_batch(pipe):
+    """Receives a batch of probe records sent by probe_batch or
+    written to a shm_ring. Returns an array of PROBE_DTYPE records or
+    None if the sender is done."""
+    if isinstance(pipe, shm_ring):
+        return pipe.recv_batch()
+    data = pipe.recv_bytes()
+    if not data: return None
+    return np.frombuffer(data, dtype=PROBE_DTYPE)
+
+
+class batch_buf(object):
+    """A blocking buffer which hands batches of probe records from the
+    pipe reader to an estimator thread.
+
+    The writer appends record arrays to a list (atomic under the GIL)
+    and only signals a waiting reader once low_water records have
+    accumulated; a waiting reader also wakes up after timeout seconds
+    to collect smaller batches. get_batch() drains all pending records
+    at once into a preallocated record array.
+    """
+
+    def __init__(self, size=4096, low_water=256, timeout=0.01):
+        self.low_water = low_water
+        self.timeout = timeout
+        self._chunks = []
+        self._arr = np.empty(size, dtype=PROBE_DTYPE)
+        self._ready = threading.Event()
+        self._waiting = False
+        self.done = False
+
+    def extend(self, recs):
+        """Append an array of PROBE_DTYPE records"""
+        chunks = self._chunks
+        chunks.append(recs)
+        if self._waiting and sum([len(c) for c in chunks]) >= self.low_water:
+            self._ready.set()               # wake up waiting reader
+
+    def append(self, seq, slot, rtt):
+        self.extend(np.array([(seq, slot, rtt)], dtype=PROBE_DTYPE))
+
+    def close(self):
+        """Notify the reader that no more records will arrive."""
+        self.done = True
+        self._ready.set()
+
+    def get_batch(self):
+        """Blocks until records are available and returns them as a
+        tuple of (seq, slot, rtt) arrays, which remain valid until the
+        next call. Returns None after close() once all records were
+        read."""
+        chunks = self._chunks
+        while not chunks:
+            if self.done: return None
+            self._ready.clear()
+            self._waiting = True
+            # check again: the writer may have appended before it saw
+            # the waiting flag
+            if not chunks and not self.done:
+                self._ready.wait(self.timeout)
+            self._waiting = False
+
+        k = len(chunks)
+        batch = chunks[:k]
+        del chunks[:k]
+        n = sum([len(c) for c in batch])
+
+        if n > len(self._arr):
+            self._arr = np.empty(n, dtype=PROBE_DTYPE)
+        arr = self._arr[:n]
+        np.concatenate(batch, out=arr)
+        return (arr['seq'], arr['slot'], arr['rtt'])
+
+
+
+class counter32(object):
+    """Extends the 32 bit sequence or slot numbers carried by the
+    probes to 64 bit counters which survive the wrap-around. Each
+    value is taken as the one closest to the largest value seen so
+    far, which is exact as long as values arrive less than 2**31 out
+    of order."""
+
+    def __init__(self, last=None):
+        self.last = last            # largest counter so far (None: the first value)
+
+    def unwrap(self, x):
+        """Returns the int64 counters of an array of 32 bit values"""
+        x = np.asarray(x, dtype=np.int64)
+        if self.last is None:
+            if not len(x): return x
+            self.last = int(x[0])
+        d = (x - self.last) & 0xFFFFFFFF
+        d[d >= 2**31] -= 2**32
+        x = self.last + d
+        if len(x) and x.max() > self.last:
+            self.last = int(x.max())
+        return x
+
+
+
+CKPT_VERSION = 2
+
+
+def save_state(fname, state):
+    """Writes the estimator state, a dict of arrays and numbers, to
+    fname in the numpy .npz format. The state is written to a
+    temporary file which is synced to disk and renamed to fname, so a
+    crash leaves either the previous or the new checkpoint. Returns
+    the write time in seconds and the file size in bytes."""
+    t = time.time()
+    tmp = fname + '.tmp'
+    fs = open(tmp, 'wb')
+    try:
+        np.savez(fs, version=CKPT_VERSION, **state)
+        fs.flush()
+        os.fsync(fs.fileno())
+    finally:
+        fs.close()
+    os.rename(tmp, fname)
+    return (time.time()-t, os.path.getsize(fname))
+
+
+def load_state(fname):
+    """Returns the state saved by save_state as a dict of arrays"""
+    try:
+        f = np.load(fname)
+        state = dict([(k, f[k]) for k in f.files])
+        f.close()
+    except (IOError, ValueError) as e:
+        ERROR('could not load checkpoint %s: %s' % (fname, e))
+    if state.pop('version', None) != CKPT_VERSION:
+        ERROR('unsupported checkpoint version: ' + fname)
+    return state
+
+
+def resume_state(est, fname=None):
+    """Restores the state of the estimator est from its checkpoint
+    (default: options.savefile + '.ckpt') when resuming a run. If
+    there is none, est starts at the resumed sequence number."""
+    if fname is None:
+        fname = options.savefile + '.ckpt'
+    if os.path.exists(fname):
+        est.load_state(load_state(fname))
+        INFO('resumed from', '%s (probe %d)' % (fname, est.last_seq+1))
+    else:
+        WARN('WARNING', 'no checkpoint %s, starting at probe %d' % (fname, options.seq0))
+        est.last_seq = options.seq0-1
+        est.last_slot = options.slot0
+
+
+
+class checkpointer(object):
+    """Writes snapshots of an estimator's state to fname (see
+    save_state) every interval seconds. The file is written by a
+    background thread, so the estimator only stalls while it copies
+    its state. A snapshot which is due while the previous one is
+    still being written is skipped."""
+
+    def __init__(self, fname, interval):
+        self.fname = fname
+        self.interval = interval
+        self.t_next = time.time() + interval
+        self.writes = 0
+        self.skipped = 0
+        self.size = 0
+        self.t_sum = 0.0
+        self.t_max = 0.0
+        self._thread = None
+
+    def due(self):
+        return self.interval > 0 and time.time() >= self.t_next
+
+    def put(self, state, wait=False):
+        """Writes state in the background. If wait is set, a pending
+        write is completed first instead of skipping state."""
+        self.t_next = time.time() + self.interval
+        if self._thread is not None and self._thread.is_alive():
+            if not wait:
+                self.skipped += 1
+                return
+            self._thread.join()
+        self._thread = threading.Thread(target=self._write, args=(state,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write(self, state):
+        try:
+            (t, size) = save_state(self.fname, state)
+        except (IOError, OSError) as e:
+            WARN('WARNING', 'could not write checkpoint %s: %s' % (self.fname, e))
+            return
+        self.writes += 1
+        self.size = size
+        self.t_sum += t
+        self.t_max = max(self.t_max, t)
+        DEBUG('checkpoint %s: %d bytes in %.3f s' % (self.fname, size, t), __name__)
+
+    def close(self, state=None):
+        """Writes the final state (if given) and waits for the write"""
+        if state is not None:
+            self.put(state, wait=True)
+        if self._thread is not None:
+            self._thread.join()
+
+    def pprint(self):
+        if not self.writes: return
+        INFO('checkpoints', '%d written to %s (%d skipped)' % (self.writes, self.fname, self.skipped))
+        INFO('checkpoint size', '%d bytes' % self.size)
+        INFO('checkpoint write time', 'mean %.3f s, max %.3f s' % (self.t_sum/self.writes, self.t_max))
+
+
+
+def test_handoff(n=10**5):
+    """Helper function to compare the throughput and the CPU usage of
+    the deque spin loop with the batch_buf hand-off of 64 record
+    batches between two threads. Both consumers are left idle for one second after the
+    last record."""
+    from collections import deque
+
+    def cputime():
+        t = os.times()
+        return t[0]+t[1]
+
+    def spin_consumer(buf):
+        while 1:
+            try:
+                (seq, slot, rtt) = buf.popleft()
+            except IndexError:
+                continue
+            if seq == -2: break
+
+    def batch_consumer(buf):
+        while 1:
+            batch = buf.get_batch()
+            if batch is None: break
+            for (seq, slot, rtt) in zip(*[a.tolist() for a in batch]):
+                pass
+
+    def spin_producer(buf):
+        for i in xrange(n):
+            buf.append((i, i, 0.0))
+        time.sleep(1.0)
+        buf.append((-2,-2,-2))
+
+    def batch_producer(buf, size=64):
+        recs = np.zeros(n, dtype=PROBE_DTYPE)
+        recs['seq'] = recs['slot'] = np.arange(n)
+        for i in xrange(0, n, size):
+            buf.extend(recs[i:i+size])
+        time.sleep(1.0)
+        buf.close()
+
+    for (name, buf, producer, consumer) in (('deque spin loop', deque(), spin_producer, spin_consumer),
+                                            ('batch_buf', batch_buf(), batch_producer, batch_consumer)):
+        t = threading.Thread(target=consumer, args=(buf,))
+        wall, cpu = time.time(), cputime()
+        t.start()
+        producer(buf)
+        t.join()
+        wall, cpu = time.time()-wall-1.0, cputime()-cpu
+        INFO(name, '%.0f records/s, %.2f s CPU for %.2f s wall time' % (n/wall, cpu, wall+1.0))
+
+
+
+def test_transport(n=10**6):
+    """Helper function to compare the throughput of the pipe and the
+    shared memory transport between a synthetic producer process,
+    which writes one record at a time like rcvloop, and a consumer."""
+
+    def producer(pipe):
+        writer = batch_writer(pipe)
+        append = writer.append
+        for i in xrange(n):
+            append(i, i, 0.0)
+        writer.close()
+
+    for name in ('pipe', 'shm_ring'):
+        if name == 'pipe':
+            (rx, tx) = multiprocessing.Pipe(duplex=False)
+        else:
+            rx = tx = shm_ring()
+
+        p = multiprocessing.Process(target=producer, args=(tx,))
+        t = time.time()
+        p.start()
+        count = 0
+        while 1:
+            recs = recv_batch(rx)
+            if recs is None: break
+            count += len(recs)
+        t = time.time()-t
+        p.join()
+        INFO(name, '%.0f records/s (%d records)' % (count/t, count))
+
+
+
+def test_handshake(n=10):
+    """Helper function to measure the ready handshake latency of a
+    polled manager namespace and of a ctrl_block."""
+
+    def sender(ns, t_set):
+        time.sleep(0.05)
+        t_set.value = time.time()
+        ns.SND_READY = True
+
+    manager = multiprocessing.Manager()
+    for name in ('manager namespace', 'ctrl_block'):
+        delays = []
+        for i in xrange(n):
+            t_set = multiprocessing.RawValue(ctypes.c_double, 0.0)
+            if name == 'ctrl_block':
+                ns = ctrl_block()
+            else:
+                ns = manager.Namespace()
+                ns.SND_READY = False
+
+            p = multiprocessing.Process(target=sender, args=(ns, t_set))
+            p.start()
+            if name == 'ctrl_block':
+                ns.wait_ready(rcv=False)
+            else:
+                while not ns.SND_READY:
+                    time.sleep(0.1)
+            delays.append(time.time()-t_set.value)
+            p.join()
+        INFO(name, 'mean handshake latency %.3f ms' % (1e3*np.mean(delays)))
+    manager.shutdown()
+
+
+
 def test_time_res():
     """Helper function to test the resolution of time.time """
     timetime = time.time          # faster: http://wiki.python.org/moin/PythonSpeed/PerformanceTips
@@ -168,26 +781,91 @@ def bar(options, stats, max_seq=None):
         print 
 
 
+def init_savefile(suffix='', raw=False):
+    """Sets the default save name (destination + YYMMDD + HHMM) unless
+    a name was given and appends the tag and suffix. Raw outputs
+    (dumps, transmitted frames) of a resumed run are saved under a new
+    name, so those of the interrupted run are not overwritten."""
+    if not options.start_time:
+        options.start_time = time.time()
+
+    if not options.savefile:
+        options.savefile = options.DST + time.strftime("_%Y%m%d_%H%M",
+                                                       time.localtime(options.start_time))
+    options.savefile += options.tag
+    if raw and options.resume:
+        options.savefile += '_resumed%d' % options.seq0
+    options.savefile += suffix
+
+
 def bar_init(options, stats, max_seq=None):
 	# start progress bar thread
+	if not options.progress or options.continuous: return
 	pbar_thread = threading.Thread(target=bar, args=(options,stats,max_seq))
 	pbar_thread.daemon = True
         pbar_thread.start()
 
 
 
-def set_affinity(ppid):
+HURST_HEADER = '% start\tH\tslope\tslots\tbusy\n'
+
+
+def hurst_row(est):
+    """Returns the line (window start in seconds, H, slope, slots,
+    busy probes) of the time-resolved Hurst parameter series for the
+    current window of est. est must provide fit() and window() (first
+    slot, slots and busy probes of the window)."""
+    (d, y0) = est.fit()
+    (start, slots, busy) = est.window()
+    return '%.3f\t%.4f\t%.4f\t%d\t%d\n' % (start*options.delta, (d+2)/2, d, slots, busy)
+
+
+
+def publish_hurst(est, name, interval):
+    """Prints the Hurst parameter estimate of the estimator thread est
+    for its current window every interval seconds while it is running
+    and appends it to options.savefile + '_H.txt' (see hurst_row)."""
+    fname = options.savefile + '_H.txt'
+    try:
+        fs = open(fname, mode='a')
+        fs.write(HURST_HEADER)
+        fs.close()
+    except IOError:
+        ERROR('could not write to ' + fname)
+
+    t_next = time.time() + interval
+    while est.is_alive():
+        time.sleep(min(0.5, interval))
+        if time.time() < t_next: continue
+        t_next += interval
+
+        row = hurst_row(est)
+        (start, H, d, slots, busy) = row.split()
+        INFO('%s H' % name, '%s (slope %s, from %s s, %s slots, %s busy)' % (H, d, start, slots, busy))
+        try:
+            fs = open(fname, mode='a')
+            fs.write(row)
+            fs.close()
+        except IOError:
+            pass
+
+
+
+def set_affinity(ppid, default=None):
     """ Attemts to set the affinity of the caller process to the CPU
     specified in options.CPUID. CPUID must be initialized, e.g., using
     load_process_affinities.
 
     Args:
         ppid: A string containing the name of the caller process. Must 
-              be either 'rcvloop','sendloop','parser' or 'main'.
+              be either 'rcvloop','sendloop','parser' or 'main', or the
+              name of a single parser process ('avparser', 'xcparser',
+              'statsparser', 'dumpwriter').
+        default: The name to look up if ppid is not mapped.
         
     """
     pid = os.getpid()
-    cpu = options.CPUID.get(ppid,None)
+    cpu = options.CPUID.get(ppid, options.CPUID.get(default))
     if not cpu: return
     
     try:
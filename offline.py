@@ -0,0 +1,445 @@
+import os
+import sys
+import glob
+import time
+import multiprocessing
+
+import numpy as np
+
+import hphelper
+
+
+options = hphelper.options
+DEBUG = hphelper.DEBUG
+INFO = hphelper.INFO
+ERROR = hphelper.err
+
+
+def dump_records(dump):
+    """Returns the seq, slot and rtt columns of a loaded dump in
+    receive order, i.e., the records dumploop sends to the parsers"""
+    seq = np.asarray(dump.rcv_order[:options.pnum]).astype(np.int64)
+    seq = seq[seq != -1]
+    return (seq, dump.slottimes[seq], dump.rtts[seq])
+
+
+def in_order(seq):
+    """Returns a mask of the probes used by the estimators. As in the
+    parser loops, a probe is discarded if its sequence number is not
+    larger than all sequence numbers received before it."""
+    last = np.maximum.accumulate(seq)
+    return seq > np.concatenate(([-1], last[:-1]))
+
+
+def probe_stats(seq, slot, rtt, ok):
+    """Returns the stats_stats the parser loops collect for the
+    records seq, slot, rtt where ok masks the in-order probes"""
+    stats = hphelper.stats_stats()
+    stats.update_batch(seq, rtt, slot)
+    stats.rx_out_of_order = int(len(ok) - ok.sum())
+    if ok.any():
+        # sum of all positive sequence number gaps
+        stats.rcv_err = int(seq[ok][-1]+1 - ok.sum())
+    return stats
+
+
+def probe_series(slot, rtt, min_rtt=None):
+    """Converts the slots and RTTs of the in-order probes into the
+    busy (True/False) values and the numbers of empty slots preceding
+    each probe which are fed to the estimators. Probes with an RTT
+    above min_rtt (default: options.min_rtt) are busy."""
+    if min_rtt is None:
+        min_rtt = options.min_rtt
+    if min_rtt == -1.0:
+        min_rtt = np.inf
+    zcounts = np.diff(np.concatenate(([0], slot))) - 1
+    return (rtt > min_rtt, zcounts)
+
+
+def feed(append_batch, probes, zcounts, size):
+    for i in xrange(0, len(probes), size):
+        append_batch(probes[i:i+size], zcounts[i:i+size])
+
+
+def xcov_batch(probes, zcounts, size):
+    """Returns the covariance estimate of the probe series. Counting
+    the lags between pairs of busy probes costs about as much per pair
+    as the FFT costs per point and log2 of the FFT length, so the
+    cheaper of the two is used."""
+    import parser_xcov
+    L = options.L
+    S = np.sum(zcounts) + len(zcounts)
+    nbusy = float(np.sum(probes))
+    nfft = 2**int(np.ceil(np.log2(S+L)))
+    if nbusy*nbusy*min(L, S)/max(S, 1) > nfft*np.log2(nfft):
+        DEBUG('FFT covariance (%d points)' % nfft, __name__)
+        return parser_xcov.xcov_fft(probes, zcounts, L, options.xc_sparse)
+
+    if options.xc_sparse:
+        xc = parser_xcov.XcovEstSparse(L)
+    else:
+        xc = parser_xcov.XcovEst(L)
+    feed(xc.append_batch, probes, zcounts, size)
+    return xc
+
+
+def segments(probes, zcounts, parts):
+    """Splits the probe series into parts consecutive segments of
+    about equal length. Returns the probes, the zcounts and the start
+    slot of each segment."""
+    bounds = np.linspace(0, len(probes), parts+1).astype(int)
+    starts = np.concatenate(([0], np.cumsum(zcounts+1)))    # slot count before each probe
+    return [(probes[a:b], zcounts[a:b], int(starts[a])) for (a, b) in zip(bounds[:-1], bounds[1:])]
+
+
+def merge_all(ests, rnd=None):
+    """Reduces the estimates of consecutive segments to one by merging
+    neighbours, left to right or, if a RandomState rnd is given, in
+    random order"""
+    ests = list(ests)
+    while len(ests) > 1:
+        i = rnd.randint(len(ests)-1) if rnd else 0
+        ests[i:i+2] = [ests[i].merge(ests[i+1])]
+    return ests[0]
+
+
+def test_merge(n=2*10**5, parts=16, L=1000, M=(1, 10, 100, 1000, 10000), rate=0.1, seed=0):
+    """Compares the estimates of a single pass over a synthetic probe
+    series with those merged from parts segments processed
+    independently. The segment states are passed through
+    state()/load_state as they would be between worker processes and
+    merged in random order. The covariance sums must be identical and
+    the variances equal up to rounding. Returns True if both agree."""
+    import parser_av
+    import parser_xcov
+    options.rate = rate
+    options.min_rtt = 0.0
+    options.progress = False
+    rnd = np.random.RandomState(seed)
+    zcounts = rnd.geometric(rate, size=n) - 1
+    # busy periods of random length
+    probes = np.repeat(rnd.rand(n//50+1) < 0.3, 50)[:n] ^ (rnd.rand(n) < 0.05)
+    M = list(M)
+
+    xc_ok = True
+    for sparse in (False, True):
+        Est = parser_xcov.XcovEstSparse if sparse else parser_xcov.XcovEst
+        xc = Est(L)
+        xc.append_batch(probes, zcounts)
+        ests = []
+        for (p, z, start) in segments(probes, zcounts, parts):
+            est = Est(L)
+            est.append_batch(p, z)
+            ests.append(Est.from_state(est.state()))
+        merged = merge_all(ests, rnd)
+        ok = (np.array_equal(xc._xc, merged._xc) and np.array_equal(xc.win, merged.win) and
+              xc._lead == merged._lead and (xc.slot_count, xc.probe_count) == (merged.slot_count, merged.probe_count))
+        INFO('xcov merge%s' % (' (sparse)' if sparse else ''), 'identical' if ok else 'DIFFERENT')
+        xc_ok = xc_ok and ok
+
+    av = parser_av.AggVarEstimator(None, None, M, progress=False, horizon=0)
+    av.append_batch(probes, zcounts)
+    ests = []
+    for (p, z, start) in segments(probes, zcounts, parts):
+        est = parser_av.AggVarEstimator(None, None, M, progress=False, horizon=0, start=start)
+        est.append_batch(p, z)
+        copy = parser_av.AggVarEstimator(None, None, M, progress=False, horizon=0)
+        copy.load_state(est.state())
+        ests.append(copy)
+    merged = merge_all(ests, rnd)
+    (v, w) = (av.avars.var(), merged.avars.var())
+    err = np.nanmax(np.abs(v-w)/v)
+    av_ok = np.array_equal(av.avars.n, merged.avars.n) and err < 1e-9
+    INFO('aggvar merge', '%s (max. relative difference %.1e)' % ('identical' if av_ok else 'DIFFERENT', err))
+    return xc_ok and av_ok
+
+
+
+def test_resume(n=10**5, size=1000, L=300, M=(1, 10, 100, 1000), horizon=5000, rate=0.1, seed=0):
+    """Feeds synthetic (seq, slot, rtt) batches of size records, with
+    1% of the probes lost, through the run loops of the aggvar and
+    xcov parsers, once in a single pass and once interrupted after a
+    third of the batches, checkpointed to disk and resumed from the
+    checkpoint, without and with a horizon. The estimates, windows
+    and loss counts must be identical. Returns True if they are."""
+    import shutil
+    import tempfile
+    import parser_av
+    import parser_xcov
+
+    class batches(object):
+        # hands one batch to the run loop per get_batch call
+        def __init__(self, recs):
+            self.recs = iter(recs)
+        def get_batch(self):
+            return next(self.recs, None)
+
+    rnd = np.random.RandomState(seed)
+    slot = np.cumsum(rnd.geometric(rate, size=n))
+    busy = np.repeat(rnd.rand(n//50+1) < 0.3, 50)[:n] ^ (rnd.rand(n) < 0.05)
+    rtt = 0.1 + busy*rnd.rand(n)
+    sent = rnd.rand(n) >= 0.01
+    (seq, slot, rtt) = (np.flatnonzero(sent), slot[sent], rtt[sent])
+    recs = [(seq[i:i+size], slot[i:i+size], rtt[i:i+size]) for i in xrange(0, len(seq), size)]
+    k = len(recs)//3
+
+    tmp = tempfile.mkdtemp()
+    (options.rate, options.min_rtt, options.L, options.progress) = (rate, 0.1, L, False)
+    (options.savefile, options.checkpoint) = (os.path.join(tmp, 'resume'), 10**9)
+    all_ok = True
+    try:
+        for h in (0, horizon):
+            for name in ('aggvar', 'xcov', 'xcov (sparse)'):
+                if name == 'aggvar':
+                    new = lambda: parser_av.AggVarEstimator(None, None, list(M), progress=False, horizon=h)
+                    result = lambda est: (est.bank().var(), est.window())
+                else:
+                    sparse = name != 'xcov'
+                    new = lambda: parser_xcov.XcovEstimator(None, None, sparse, progress=False, horizon=h)
+                    result = lambda est: (est.xc.xc, est.window())
+                ests = [new(), new(), new()]
+                for (est, part) in zip(ests, (recs, recs[:k], recs[k:])):
+                    if est is ests[2]:
+                        hphelper.resume_state(est)
+                    est.buf = batches(part)
+                    est.run()
+                ((v, win), (w, win2)) = (result(ests[0]), result(ests[2]))
+                ok = (np.allclose(v, w, rtol=0, atol=0, equal_nan=True) and win == win2 and
+                      ests[0].stats.rcv_err == ests[2].stats.rcv_err and ests[0].last_seq == ests[2].last_seq)
+                INFO('%s resume (horizon %d)' % (name, h), 'identical' if ok else 'DIFFERENT')
+                all_ok = all_ok and ok
+    finally:
+        shutil.rmtree(tmp)
+    return all_ok
+
+
+def summary(method, stats, d=np.nan):
+    # one row of the batch summary table
+    return {'method':method, 'H':(d+2)/2, 'slope':d, 'probes':stats.rx_total,
+            'loss':1.0*stats.rcv_err/max(1, stats.rcv_err + stats.rx_total - stats.rx_out_of_order),
+            'mean_rtt':stats.mean_rtt()}
+
+
+def analyze(dump, size=2**17):
+    """Analyzes a loaded dump within the main process. The estimators
+    selected by the options are fed with vectorized batches of size
+    probes; the printed results and the saved files are the same as
+    those of the parser processes. Returns a summary (see summary) for
+    each estimator."""
+    run_start = time.time()
+    results = []
+
+    (seq, slot, rtt) = dump_records(dump)
+    ok = in_order(seq)
+    (probes, zcounts) = probe_series(slot[ok], rtt[ok])
+    savefile = options.savefile
+
+    if options.hist:
+        import parser_stats
+        stats = probe_stats(seq, slot, rtt, ok)
+        stats.min_rtt = rtt.min() if len(rtt) else np.inf
+        rtts = -1.0*np.ones(options.pnum)
+        rtts[seq] = rtt
+        rtts = rtts[rtts!=-1]
+        if not any(rtts):
+            ERROR("could not calculate average delay")
+        stats.run_start = run_start
+        stats.run_end = time.time()
+        parser_stats.rttreport(stats, rtts)
+        results.append(summary('hist', stats))
+
+    if options.aggvar:
+        import parser_av
+        options.savefile = savefile
+        hphelper.init_savefile('_av')
+        av = parser_av.AggVarEstimator(None, dump.slottimes, progress=False, horizon=0)
+        feed(av.append_batch, probes, zcounts, size)
+
+        av.stats = probe_stats(seq, slot, rtt, ok)
+        av.stats.run_start = run_start
+        av.stats.run_end = time.time()
+        av.stats.pprint()
+        parser_av.avsave(av)
+        parser_av.avplotter(av)
+        results.append(summary('aggvar', av.stats, av.fit()[0]))
+
+    if options.xcov:
+        import parser_xcov
+        options.savefile = savefile
+        hphelper.init_savefile('_xc')
+        xc = parser_xcov.XcovEstimator(None, dump.slottimes, progress=False, horizon=0)
+        xc.xc = xcov_batch(probes, zcounts, size)
+
+        xc.stats = probe_stats(seq, slot, rtt, ok)
+        xc.stats.run_start = run_start
+        xc.stats.run_end = time.time()
+        xc.stats.rx_slots = xc.xc.slot_count
+        xc.stats.pprint()
+        parser_xcov.xcsave(xc)
+        parser_xcov.xcplotter(xc)
+        results.append(summary('xcov', xc.stats, xc.fit()[0]))
+
+    DEBUG('done', __name__)
+    return results
+
+
+
+def epoch_ends(zcounts, epoch):
+    """Returns the indices at which the probe series is split into
+    epochs: each part ends with the first probe which completes a
+    multiple of epoch slots. Probes after the last complete epoch are
+    omitted."""
+    pos = np.cumsum(zcounts+1)             # slot count after each probe
+    if not len(pos): return pos
+    ends = np.searchsorted(pos, np.arange(epoch, pos[-1]+1, epoch)) + 1
+    return np.unique(ends)
+
+
+def track_series(est, probes, zcounts, size):
+    """Feeds the probe series epoch by epoch to an estimator with a
+    horizon of options.horizon slots and returns the lines (see
+    hphelper.hurst_row) of all complete windows. est.update() retires
+    the oldest epoch, so each probe is added once and the cost grows
+    linearly with the dump."""
+    rows = []
+    i = 0
+    for j in epoch_ends(zcounts, max(1, options.horizon//options.epochs)):
+        feed(est.append_batch, probes[i:j], zcounts[i:j], size)
+        est.update()
+        i = j
+        (start, slots, busy) = est.window()
+        if start+slots >= options.horizon:
+            rows.append(hphelper.hurst_row(est))
+    return rows
+
+
+def save_series(rows, fname):
+    print "saving H(t) series to " + fname + " ..."
+    fs = open(fname, mode='w')
+    fs.write(hphelper.HURST_HEADER)
+    fs.writelines(rows)
+    fs.close()
+
+
+def track(dump, size=2**17):
+    """Estimates the Hurst parameter of a loaded dump over sliding
+    windows of options.horizon slots which advance by one epoch
+    (horizon/options.epochs slots). The selected estimators are fed
+    with the whole dump once; the series are saved as with the live
+    --track output to options.savefile + '_av_H.txt' and '_xc_H.txt'.
+    Returns the lines of the series for each estimator."""
+    (seq, slot, rtt) = dump_records(dump)
+    ok = in_order(seq)
+    (probes, zcounts) = probe_series(slot[ok], rtt[ok])
+    savefile = options.savefile
+    INFO('tracking H', 'window %d slots, step %d slots' % (options.horizon, max(1, options.horizon//options.epochs)))
+
+    series = {}
+    if options.aggvar:
+        import parser_av
+        av = parser_av.AggVarEstimator(None, dump.slottimes, progress=False, horizon=options.horizon)
+        series['aggvar'] = track_series(av, probes, zcounts, size)
+
+    if options.xcov:
+        import parser_xcov
+        xc = parser_xcov.XcovEstimator(None, dump.slottimes, progress=False, horizon=options.horizon)
+        series['xcov'] = track_series(xc, probes, zcounts, size)
+
+    for (method, suffix) in (('aggvar', '_av'), ('xcov', '_xc')):
+        if method not in series: continue
+        if not series[method]:
+            hphelper.WARN('WARNING', 'dump is shorter than the tracking window')
+            continue
+        options.savefile = savefile
+        hphelper.init_savefile(suffix)
+        save_series(series[method], options.savefile + '_H.txt')
+    options.savefile = savefile
+    return series
+
+
+
+def analyze_file(args):
+    """Loads and analyzes a single dump file in a worker process.
+    The options are reset to base first since loading a dump changes
+    them. Returns the summaries of analyze, each with the file name
+    and the runtime."""
+    (fname, base) = args
+    import capture
+
+    t = time.time()
+    stdout = sys.stdout
+    if not options.DEBUG:
+        sys.stdout = open(os.devnull, 'w')
+    try:
+        options.__dict__.update(base)
+        options.loaddump = fname
+        options.tag += '_offline'
+        results = analyze(capture.dump_loader())
+        err = None
+    except SystemExit as e:
+        results = []
+        err = 'exited with code %s' % e.code
+    except Exception as e:
+        results = []
+        err = str(e) or e.__class__.__name__
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    if err is not None:
+        print 'error analyzing ' + fname + ': ' + err
+        return [{'file':fname, 'method':'error', 'runtime':time.time()-t}]
+    for r in results:
+        r['file'] = fname
+        r['runtime'] = time.time()-t
+    return results
+
+
+def analyze_files(patterns, workers=None, fname=None):
+    """Analyzes the dump files matching the list of file names or
+    glob patterns in a pool of workers (default: one per CPU). Each
+    file is analyzed as with --load and saves the same files. A
+    summary table with one row per file and estimator is written to
+    fname."""
+    files = []
+    for p in patterns:
+        files += sorted(glob.glob(p)) or [p]
+    if not files:
+        ERROR('no dump files specified')
+
+    if not workers:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(files))
+    INFO('analyzing dumps', '%d files (%d workers)' % (len(files), workers))
+
+    base = dict(options.__dict__)
+    t = time.time()
+    pool = multiprocessing.Pool(workers)
+    try:
+        # get with a timeout so that KeyboardInterrupt is delivered
+        rows = pool.map_async(analyze_file, [(f, base) for f in files], chunksize=1).get(10**9)
+    except KeyboardInterrupt:
+        pool.terminate()
+        print 'batch analysis canceled.'
+        return
+    pool.close()
+    pool.join()
+    rows = sum(rows, [])
+    INFO('batch runtime', '%.2f s' % (time.time()-t))
+
+    if not fname:
+        fname = 'batch' + time.strftime("_%Y%m%d_%H%M") + options.tag + '.txt'
+    print "saving summary to " + fname + " ..."
+    fs = open(fname, mode='w')
+    fs.write('% file\tmethod\tH\tslope\tprobes\tloss\tmean_rtt\truntime\n')
+    for r in rows:
+        if r['method'] == 'error':
+            line = '%s\terror\tnan\tnan\t0\tnan\tnan\t%.2f\n' % (r['file'], r['runtime'])
+        else:
+            line = '%s\t%s\t%.4f\t%.4f\t%d\t%.6f\t%.6f\t%.2f\n' % (r['file'], r['method'], r['H'], r['slope'],
+                                                                   r['probes'], r['loss'], r['mean_rtt'], r['runtime'])
+        fs.write(line)
+        print line,
+    fs.close()
+    return rows
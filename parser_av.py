@@ -2,10 +2,10 @@
 # GPL2
 # Zdravko Bozakov (zb@ikt.uni-hannover.de)
 
+import collections
 import time
 import threading
 import warnings
-from collections import deque
 
 try:
     import numpy as np
@@ -26,7 +26,6 @@ import hplotting
 
 warnings.simplefilter('ignore', np.RankWarning)
 
-np_append = np.append
 options = hphelper.options
 DEBUG = hphelper.DEBUG
 ERROR = hphelper.err
@@ -52,6 +51,16 @@ class var_est(object):
         self.mean += delta/self.n
         self.M2 += delta*(x - self.mean)
 
+    def step_n(self, x, k):
+        """Receive k identical samples x at once and update the
+        variance in closed form"""
+        if k<1: return
+        n = self.n + k
+        delta = x - self.mean
+        self.mean += delta*k/n
+        self.M2 += delta*delta*self.n*k/n
+        self.n = n
+
     def var(self):
         """Returns the variance estimate for the current aggregation
         level. Returns NaN if less than N_MIN samples were available for
@@ -64,6 +73,22 @@ class var_est(object):
         self.M2 = self.M2/self.n 
         self.n = 1
 
+    def state(self):
+        """Returns the sample count, mean and M2 sum"""
+        return (self.n, self.mean, self.M2)
+
+    def merge(self, other):
+        """Combine the samples of another estimator into this one
+        (parallel variance algorithm by Chan et al.)"""
+        (n_b, mean_b, M2_b) = other.state()
+        n = self.n + n_b
+        if not n: return self
+        delta = mean_b - self.mean
+        self.mean = (self.n*self.mean + n_b*mean_b)/n
+        self.M2 += M2_b + delta*delta*self.n*n_b/n
+        self.n = n
+        return self
+
     def __str__(self):
         return '%f\t%.6f\t%d\t%.6f\n' % (self.M, self.var(), self.n, self.mean)
 
@@ -72,6 +97,80 @@ class var_est(object):
 
 
 
+class var_bank(object):
+    """A bank of online variance estimators, one for each
+    aggregation level. The sample counts, means and M2 sums of all
+    levels are stored in arrays so that any subset of levels can be
+    updated with a single vectorized call.
+    """
+
+    N_MIN = var_est.N_MIN      # minimum number of samples required to
+                               # return a variance estimate
+
+    def __init__(self, M):
+        self.M = np.asarray(M) # aggregation levels: only used for printing
+        self.n = np.zeros(len(self.M), dtype=int)
+        self.mean = np.zeros(len(self.M))
+        self.M2 = np.zeros(len(self.M))
+
+    def step(self, idx, x, k=1):
+        """Receive k identical samples x for each of the levels
+        selected by idx (an index array or boolean mask) and update the
+        variances. x and k may be scalars or arrays matching idx."""
+        idx = np.arange(len(self.n))[idx]
+        x = x + np.zeros(len(idx))
+        k = k + np.zeros(len(idx), dtype=int)
+        if not np.all(k>0):
+            idx, x, k = idx[k>0], x[k>0], k[k>0]
+
+        n_a = self.n[idx]
+        n = n_a + k
+        delta = x - self.mean[idx]
+        self.mean[idx] += delta*k/n
+        self.M2[idx] += delta*delta*n_a*k/n
+        self.n[idx] = n
+
+    def var(self):
+        """Returns the variance estimates of all levels. Returns NaN
+        for levels with less than N_MIN samples"""
+        v = np.nan*np.ones(len(self.n))
+        ok = self.n>=self.N_MIN
+        v[ok] = self.M2[ok]/(self.n[ok] - 1)
+        return v
+
+    def freeze(self):
+        """Reset sample counters for numeric stability"""
+        ok = self.n>0
+        self.M2[ok] = self.M2[ok]/self.n[ok]
+        self.n[ok] = 1
+
+    def add(self, idx, n, mean, M2):
+        """Add the samples summarized by their count n, mean and M2
+        to the levels selected by idx (parallel variance algorithm by
+        Chan et al.). n, mean and M2 may be scalars or arrays matching
+        idx."""
+        idx = np.arange(len(self.n))[idx]
+        n_a = self.n[idx]
+        n_ab = n_a + n
+        nn = np.maximum(n_ab, 1)
+        delta = mean - self.mean[idx]
+        self.mean[idx] = (n_a*self.mean[idx] + n*mean)/nn
+        self.M2[idx] += M2 + delta*delta*n_a*n/nn
+        self.n[idx] = n_ab
+
+    def merge(self, other):
+        """Combine the samples of another bank with the same levels
+        into this one. The result equals a single bank fed with the
+        samples of both, up to rounding, and does not depend on the
+        order of merging."""
+        self.add(slice(None), other.n, other.mean, other.M2)
+        return self
+
+    def __str__(self):
+        return ''.join(['%f\t%.6f\t%d\t%.6f\n' % t for t in zip(self.M, self.var(), self.n, self.mean)])
+
+
+
 try:
     var_est = hpfast.var_est
     DEBUG('using hpfast.var_est', __name__)
@@ -81,33 +180,64 @@ except (NameError, AttributeError) as e:
 
 
 class AggVarEstimator(threading.Thread):
-  
-    def __init__(self, buf, slots, M=None):
+    """Estimates the aggregate variance of the busy/idle slot series
+    for the aggregation levels M. With a horizon (in slots, default:
+    options.horizon in continuous mode or with --track) the estimate
+    only covers the last epochs complete epochs of horizon/epochs
+    slots and the current one: the variance bank is replaced every
+    epoch and the banks of the retained epochs are merged when the
+    variances are read, so memory stays constant."""
+
+    def __init__(self, buf, slots, M=None, progress=True, horizon=None, epochs=None, start=0):
 
         
         self.buf = buf
         self.slots = slots
-        if not M:
+        if M is None or not len(M):
             #M = range(options.M[0], options.M[1], 300)
             M = 10**np.linspace(np.log10(options.M[0]),np.log10(options.M[1]),200)
             M = np.unique(np.floor(M)).astype(int)
 
         self.M = M            
 
-        # sliding window to store arriving values
-        self.win = np.zeros(np.max(M)).astype(bool)
+        # the variance bank stores an estimator for each aggregation
+        # level in M. Ensure that we calculate the variance at the
+        # smallest aggregate level, even when it was not specified by
+        # the user
+        self._levels = np.union1d(M, [1]).astype(int)
+        self._midx = np.searchsorted(self._levels, M)
+        self.avars = var_bank(self._levels)
 
-        # avars stores an estimator for each aggregation level in M
-        self.avars = dict.fromkeys(M,0)
-        # ensure that we calculate the variance at the smallest
-        # aggregate level, even when it was not specified by the user
-        self.avars[1] = 0 
-        for m in self.avars.iterkeys():
-            self.avars[m] = var_est(m)
+        # running sum of the current block for each aggregation level
+        self._bsum = np.zeros(len(self._levels))
+
+        # a segment of a trace starting at slot start (see merge) holds
+        # back the sums of the blocks which began before start
+        self.start = start
+        self._hpart = start % self._levels != 0     # segment starts within a block
+        self._hopen = self._hpart.copy()             # that block is not complete yet
+        self._hsum = np.zeros(len(self._levels))     # busy probes of that block within the segment
 
 
         self.probe_count = 0
-        self.slot_count = 0
+        self.slot_count = start
+
+        if horizon is None:
+            horizon = options.horizon if (options.continuous or options.track) else 0
+        if epochs is None:
+            epochs = options.epochs
+        self.horizon = horizon
+        self.epochs = epochs
+        self.epoch = max(1, horizon//epochs)
+        self._done = collections.deque()    # (bank, probe_count, slot_count) of the retained epochs
+        self._retired = var_bank(self._levels)  # samples of the epochs dropped from the horizon
+        self._base = (0, start)             # probe and slot count before the oldest retained epoch
+        self._next = self.epoch
+        self._lock = threading.Lock()       # update() against bank() and window() of other threads
+
+        self.last_seq = -1                  # position of the run, see state()
+        self.last_slot = 0
+        self.ckpt = None
 
 
         self.stats = hphelper.stats_stats()
@@ -117,7 +247,8 @@ class AggVarEstimator(threading.Thread):
 
 
         # start progress bar thread 
-        hphelper.bar_init(options, self.stats)
+        if progress:
+            hphelper.bar_init(options, self.stats)
 
         threading.Thread.__init__(self)
 
@@ -125,84 +256,244 @@ class AggVarEstimator(threading.Thread):
 
     def run(self):
         stats = self.stats
-        last_seq = -1                                       # store maximum sequence number received until now
-        last_slot = 0
+        last_seq = self.last_seq                            # store maximum sequence number received until now
+        last_slot = self.last_slot
 
         if options.min_rtt == -1.0:
             min_rtt = np.inf
         else:
             min_rtt = options.min_rtt
 
+        # sequence and slot numbers wrap around in continuous runs
+        seqs = hphelper.counter32(last_seq+1)
+        slots = hphelper.counter32(last_slot)
+        self.ckpt = ckpt = hphelper.checkpointer(options.savefile + '.ckpt', options.checkpoint)
 
+        get_batch = self.buf.get_batch
         while 1:
-            try:
-                (seq, slot, rtt) = self.buf.popleft()
-            except IndexError:
+            batch = get_batch()                          # block until records are available
+            if batch is None: break
+            batch = (seqs.unwrap(batch[0]), slots.unwrap(batch[1]), batch[2])
+
+            for (seq, slot, rtt) in zip(*[a.tolist() for a in batch]):
+                stats.update(seq, rtt, slot)
+
+                if seq!=last_seq+1:
+                    # unexpected sequence number 
+                    seq_delta = seq-last_seq-1
+                    if seq_delta<0:
+                        # discard probe if it was received out of order
+                        # seq_delta == -1 --> duplicate packet
+                        stats.rx_out_of_order += 1
+                        continue
+
+                    # all intermediate packets were missing
+                    stats.rcv_err += seq_delta
+
+                ## packet was not sent correctly!
+                #if slot == -1.0:
+                #    stats.snd_err += 1
+                #    continue
+                ## each dropped probe indicates a full queue append, a
+                ## 1 to the covariance vector
+                #while seq!=last_seq+1:
+                #    last_seq += 1
+                #    next_slot = slots[last_seq]
+                #    if next_slot==-1:                         # slottimes vector might be incomplete
+                #        continue
+                #    slot_delta = next_slot - last_slot
+                #    last_slot = next_slot
+                #    stats.rcv_err += 1                        # increment dropped packets counter
+                #    self.append_fast(True, slot_delta-1)
+
+
+                last_seq = seq
+
+
+                slot_delta = slot - last_slot
+                last_slot = slot
+
+                # update the minimum RTT on the fly. Only update if the
+                # RTT was not specified as an option
+                #if options.min_rtt == -1.0:                  
+                #    min_rtt = min(rtt, min_rtt)
+
+                # check if probe saw a busy period (True/False) 
+                probe = rtt > min_rtt
+
+                self.append_fast(probe, slot_delta-1)
+
+            self.update()
+
+            if ckpt.due():
+                (self.last_seq, self.last_slot) = (last_seq, last_slot)
+                ckpt.put(self.state())
+
+        (self.last_seq, self.last_slot) = (last_seq, last_slot)
+        if options.checkpoint:
+            ckpt.close(self.state())
+
+
+
+    def merge(self, other):
+        """Appends the estimate of the segment other, which starts at
+        the slot where this estimate ends (other.start ==
+        self.slot_count), and returns self. Blocks spanning the segment
+        boundary are completed from the running sums of this estimate
+        and the held back sums of other, so merging the segments of a
+        trace gives the same variances as a single pass, up to
+        rounding. Merges of adjacent segments may be reduced in any
+        order. Both estimates must use the same levels and no
+        horizon."""
+        if other.start != self.slot_count:
+            raise ValueError('segment starts at slot %d, expected %d' % (other.start, self.slot_count))
+        if self.horizon or other.horizon or not np.array_equal(self._levels, other._levels):
+            raise ValueError('only estimates with the same levels and no horizon can be merged')
+
+        self.avars.merge(other.avars)
+        levels = self._levels
+        for i in np.flatnonzero(other._hpart):
+            if other._hopen[i]:
+                # the block is still not complete
+                self._bsum[i] += other._bsum[i]
                 continue
-
-            if seq == -2: break
-
-            stats.update(seq, rtt, slot)
-
-            if seq!=last_seq+1:
-                # unexpected sequence number 
-                seq_delta = seq-last_seq-1
-                if seq_delta<0:
-                    # discard probe if it was received out of order
-                    # seq_delta == -1 --> duplicate packet
-                    stats.rx_out_of_order += 1
-                    continue
-
-                # all intermediate packets were missing
-                stats.rcv_err += seq_delta
-
-            ## packet was not sent correctly!
-            #if slot == -1.0:
-            #    stats.snd_err += 1
-            #    continue
-            ## each dropped probe indicates a full queue append, a
-            ## 1 to the covariance vector
-            #while seq!=last_seq+1:
-            #    last_seq += 1
-            #    next_slot = slots[last_seq]
-            #    if next_slot==-1:                         # slottimes vector might be incomplete
-            #        continue
-            #    slot_delta = next_slot - last_slot
-            #    last_slot = next_slot
-            #    stats.rcv_err += 1                        # increment dropped packets counter
-            #    self.append_fast(True, slot_delta-1)
-
-
-            last_seq = seq
-
-
-            slot_delta = slot - last_slot
-            last_slot = slot
-
-            # update the minimum RTT on the fly. Only update if the
-            # RTT was not specified as an option
-            #if options.min_rtt == -1.0:                  
-            #    min_rtt = min(rtt, min_rtt)
-
-            # check if probe saw a busy period (True/False) 
-            probe = rtt > min_rtt
-
-            self.append_fast(probe, slot_delta-1)
+            s = self._bsum[i] + other._hsum[i]
+            if self._hopen[i]:
+                # both segments lie within the first block of this one
+                self._hsum[i] = s
+                self._hopen[i] = False
+            else:
+                self.avars.step([i], s/levels[i])
+            self._bsum[i] = other._bsum[i]
+        aligned = ~other._hpart
+        self._bsum[aligned] = other._bsum[aligned]
+
+        self.probe_count += other.probe_count
+        self.slot_count = other.slot_count
+        return self
+
+
+
+    def state(self):
+        """Returns a copy of the estimator state and of the position
+        of the run (last sequence and slot number) for checkpoints"""
+        done = list(self._done)
+        state = {'levels':self._levels, 'bsum':self._bsum.copy(),
+                 'n':self.avars.n.copy(), 'mean':self.avars.mean.copy(), 'M2':self.avars.M2.copy(),
+                 'probe_count':self.probe_count, 'slot_count':self.slot_count, 'start':self.start,
+                 'hpart':self._hpart, 'hopen':self._hopen.copy(), 'hsum':self._hsum.copy(),
+                 'horizon':self.horizon, 'epochs':self.epochs, 'next':self._next, 'base':self._base,
+                 'done_n':np.array([b.n for (b, p, sl) in done]).reshape(-1, len(self._levels)),
+                 'done_mean':np.array([b.mean for (b, p, sl) in done]).reshape(-1, len(self._levels)),
+                 'done_M2':np.array([b.M2 for (b, p, sl) in done]).reshape(-1, len(self._levels)),
+                 'done_counts':np.array([(p, sl) for (b, p, sl) in done]).reshape(-1, 2),
+                 'retired_n':self._retired.n.copy(), 'retired_mean':self._retired.mean.copy(),
+                 'retired_M2':self._retired.M2.copy(),
+                 'seq':self.last_seq, 'slot':self.last_slot, 'min_rtt':options.min_rtt}
+        state.update(self.stats.state())
+        return state
+
+
+
+    def load_state(self, state):
+        """Restores a state returned by state()"""
+        if not np.array_equal(state['levels'], self._levels):
+            ERROR('the checkpoint was saved with different aggregation levels')
+        if state['horizon'] != self.horizon or state['epochs'] != self.epochs:
+            ERROR('the checkpoint was saved with a different horizon')
+
+        def bank(n, mean, M2):
+            b = var_bank(self._levels)
+            (b.n[:], b.mean[:], b.M2[:]) = (n, mean, M2)
+            return b
+
+        self.avars = bank(state['n'], state['mean'], state['M2'])
+        self._bsum[:] = state['bsum']
+        self.probe_count = int(state['probe_count'])
+        self.slot_count = int(state['slot_count'])
+        self.start = int(state['start'])
+        self._hpart = state['hpart'].copy()
+        self._hopen = state['hopen'].copy()
+        self._hsum[:] = state['hsum']
+        self._next = int(state['next'])
+        self._base = tuple(np.asarray(state['base']).tolist())
+        self._done = collections.deque([(bank(*b), int(p), int(sl)) for (b, (p, sl)) in
+                                        zip(zip(state['done_n'], state['done_mean'], state['done_M2']),
+                                            state['done_counts'])])
+        self._retired = bank(state['retired_n'], state['retired_mean'], state['retired_M2'])
+        self.last_seq = int(state['seq'])
+        self.last_slot = int(state['slot'])
+        self.stats.load_state(state)
+
+
+
+    def update(self):
+        """Starts a new epoch if the current one is complete and retires
+        the oldest epoch once the horizon is covered"""
+        if not self.horizon or self.slot_count < self._next: return
+        with self._lock:
+            self._done.append((self.avars, self.probe_count, self.slot_count))
+            self.avars = var_bank(self._levels)
+            while len(self._done) > self.epochs:
+                (b, probes, slots) = self._done.popleft()
+                self._retired.merge(b)
+                self._base = (probes, slots)
+        self._next = self.slot_count - self.slot_count % self.epoch + self.epoch
+
+
+
+    def bank(self):
+        """Returns the variance bank of the samples within the horizon.
+        May be called by other threads (plotter, publisher) while the
+        estimator thread starts new epochs."""
+        with self._lock:
+            (done, avars) = (list(self._done), self.avars)
+        if not done:
+            return avars
+        bank = var_bank(self._levels)
+        for (b, probes, slots) in done:
+            bank.merge(b)
+        return bank.merge(avars)
+
+
+
+    def total(self):
+        """Returns an estimator without horizon holding the variances
+        of the whole run, including the retired epochs"""
+        av = AggVarEstimator(None, self.slots, self.M, progress=False, horizon=0, start=self.start)
+        with self._lock:
+            banks = [b for (b, probes, slots) in self._done] + [self.avars]
+            av.avars = var_bank(self._levels).merge(self._retired)
+        for b in banks:
+            av.avars.merge(b)
+        (av.probe_count, av.slot_count) = (self.probe_count, self.slot_count)
+        av.stats = self.stats
+        return av
+
+
+
+    def window(self):
+        """Returns the first slot, the number of slots and the number
+        of busy probes within the horizon"""
+        with self._lock:
+            (probes, slots) = self._base
+        return (slots, self.slot_count - slots, self.probe_count - probes)
 
 
 
     def get_avars(self):
         """Returns the variances estimated so far for all aggregation
         levels stored in M"""
-        return [self.avars[m].var() for m in self.M]
+        return self.bank().var()[self._midx]
 
 
 
     def get_avars_corrected(self):
         """Returns the variances for all aggregation levels, corrected
         to account for the geometric sampling process"""
-        var_w = self.avars[1].var()
-        vw = self.get_avars()
+        var = self.bank().var()
+        var_w = var[0]
+        vw = var[self._midx]
 
         mean_y_hat = self.mean()/self.mean_a
         var_y_hat = (var_w - mean_y_hat**2*self.var_a)/(self.var_a + self.mean_a**2);
@@ -243,27 +534,86 @@ class AggVarEstimator(threading.Thread):
 
 
     def append_fast(self, probe, zcount=0):
-        ''' Append the latest received probe to a sliding
-        window. Update the aggregate variances for each variance
-        block '''
+        ''' Append the latest received probe after zcount empty
+        slots. Each aggregation level keeps the running sum of its
+        current block, so the cost per probe does not depend on the
+        aggregation level. The empty slots are skipped in closed form:
+        the first completed block gets the running sum, all further
+        blocks within the gap are zero. '''
         self.probe_count += probe
 
-        z=[False]*zcount
-        z.append(bool(probe))
-
-        for x in z:
-            # speed: np.r_ < np.roll < np.concatenate < np.append 
-            self.win = np_append(self.win[1:], x)
-            self.slot_count += 1
-
-            [var.step(np.mean(self.win[-m:])) for m,var in self.avars.iteritems() if not self.slot_count % m]
+        levels = self._levels
+        bsum = self._bsum
+        avars = self.avars
+        s = self.slot_count
+
+        if zcount:
+            # number of blocks which end within the empty slots
+            nb = (s+zcount)//levels - s//levels
+            done = nb>0
+            avars.step(done, bsum[done]/levels[done])
+            avars.step(done, 0.0, nb[done]-1)
+            bsum[done] = 0.0
+
+        s += zcount+1
+        self.slot_count = s
+
+        if probe:
+            bsum += 1.0
+
+        # blocks which end with the current slot
+        done = s % levels == 0
+        avars.step(done, bsum[done]/levels[done])
+        bsum[done] = 0.0
+
+
+
+    def append_batch(self, probes, zcounts):
+        ''' Append an array of probes, each received after the
+        corresponding number of empty slots in zcounts. Equivalent to
+        calling append_fast for each probe: for each aggregation level
+        the busy probes are counted per block with a single bincount
+        and the completed blocks are added to the variance bank as one
+        group of samples. Segments with a start slot must be fed with
+        append_batch. '''
+        probes = np.asarray(probes, dtype=bool)
+        steps = np.asarray(zcounts, dtype=int)+1
+        if not len(steps): return
+
+        s0 = self.slot_count
+        pos = s0 + np.cumsum(steps)            # slot count after each probe
+        s1 = int(pos[-1])
+        busy = pos[probes]-1                   # zero based slots of the busy probes
+        self.probe_count += len(busy)
+
+        bsum = self._bsum
+        avars = self.avars
+        for (i, m) in enumerate(self._levels):
+            b0 = s0//m
+            nb = s1//m - b0                    # number of blocks completed by this batch
+            counts = np.bincount(busy//m - b0, minlength=nb+1).astype(float)
+            counts[0] += bsum[i]
+            if nb:
+                x = counts[:nb]/m
+                if self._hopen[i]:
+                    # the first block of a segment is completed by merge
+                    self._hsum[i] = counts[0]
+                    self._hopen[i] = False
+                    x = x[1:]
+                if len(x):
+                    mean = x.mean()
+                    avars.add(i, len(x), mean, np.sum((x-mean)**2))
+            bsum[i] = counts[nb]
+
+        self.slot_count = s1
 
 
             
     def mean(self):
         ''' return the mean of the observation vector mu_w '''
+        (start, slots, probes) = self.window()
         try:
-            return self.probe_count*1.0/self.slot_count
+            return probes*1.0/slots
         except:
             return np.nan
 
@@ -285,51 +635,73 @@ except (NameError, AttributeError) as e:
 
 
 
+def avsave(av):
+    """Print the Hurst parameter estimate and save the corrected
+    variances to options.savefile + '.dat'"""
+    if av.horizon and not options.continuous:
+        # the horizon only applies to the published and tracked rows
+        av = av.total()
+    print
+    print "\tH=%.2f" % (av.hurst(),)
+    print 
+
+
+    fname = options.savefile + '.dat'
+    print "saving variances to " + fname + " ..."
+    try:
+            fs = open(fname, mode='w')
+            fs.write('% ' + options.IPDST + ' ' + str(options))
+
+            for m,v in zip(av.get_avars_corrected(), av.M):
+                fs.write("%e\t%d\n" % (m,v))
+            fs.close()
+    except IOError:
+            ERROR('could not write to file')
+    except KeyboardInterrupt:
+            print 'canceled saving.'
+
+
+
 def avparser(pipe, ns, ST=None):
-    if not options.start_time:
-        options.start_time = time.time()
-  
-    if not options.savefile:
-        # default save name is destination + YYMMDD + HHMM
-        options.savefile = options.DST + time.strftime("_%Y%m%d_%H%M", 
-                                                       time.localtime(options.start_time)) 
-    options.savefile += options.tag 
-    options.savefile += '_av'
+    hphelper.set_affinity('avparser', 'parser')
+    hphelper.init_savefile('_av')
 
 
-    rcv_buf = deque() # TODO
+    rcv_buf = hphelper.batch_buf()
 
     # init estimator thread
     av = AggVarEstimator(rcv_buf, ST)
     av.daemon = True
+    if options.resume:
+        hphelper.resume_state(av)
 
     # init plotter thread
     avplotter_thread = threading.Thread(target=avplotter, args=(av,))
     avplotter_thread.daemon = True
 
     #block until sender + receiver say they are ready
-    while not all([ns.RCV_READY,ns.SND_READY]):
-        time.sleep(0.1)
+    ns.wait_ready()
 
     av.stats.run_start = time.time()
 
     # start threads
     avplotter_thread.start()
     av.start()
+    if (options.continuous or options.track) and options.publish:
+        publisher = threading.Thread(target=hphelper.publish_hurst, args=(av, 'aggvar', options.publish))
+        publisher.daemon = True
+        publisher.start()
 
-    data = None
     try:
         while 1:                                              # faster than while True
-            data = pipe.recv()
-            (seq, snd_time, rtt) = data
-            rcv_buf.append((seq, snd_time, rtt))              # receive (seq, snd_time, rtt) from rcvloop process
+            recs = hphelper.recv_batch(pipe)                  # receive (seq, slot, rtt) records from rcvloop process
+            if recs is None: break
+            rcv_buf.extend(recs)
+        print '\a', # received all packets
 
     except (KeyboardInterrupt):
-        rcv_buf.append((-2,-2,-2))
         print '\n\nparse loop interrupted...'
-    except (ValueError) as e:
-        rcv_buf.append((-2,-2,-2))
-        print '\a', # received all packets
+    rcv_buf.close()
 
 
 
@@ -341,26 +713,9 @@ def avparser(pipe, ns, ST=None):
 
     av.stats.run_end = time.time()
     av.stats.pprint()
+    av.ckpt.pprint()
 
-    print
-    print "\tH=%.2f" % (av.hurst(),)
-    print 
-
-
-    fname = options.savefile + '.dat'
-    print "saving variances to " + fname + " ..."
-    try:
-            fs = open(fname, mode='w')
-            fs.write('% ' + options.IPDST + ' ' + str(options))
-
-            for m,v in zip(av.get_avars_corrected(), av.M):
-                fs.write("%e\t%d\n" % (m,v))
-            fs.close()
-    except IOError:
-            ERROR('could not write to file')
-            return
-    except KeyboardInterrupt:
-            print 'canceled saving.'
+    avsave(av)
 
     DEBUG('done', __name__)
 
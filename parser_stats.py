@@ -32,13 +32,28 @@ def plot_hist(rtts):
 
 
 
+def rttreport(stats, rtts):
+    """Print the statistics together with the RTT median, standard
+    deviation and maximum and plot the RTT histogram if requested"""
+    stats.append_stats(median=('RTT median','%.6f' % median(rtts)),
+                       std=('RTT std. dev.','%.6f' % std(rtts)),
+                       #min=('min RTT','%.6f' % min(rtts)),
+                       max=('RTT maximum','%.6f' % max(rtts)),
+                       )
+
+    stats.pprint()
+
+    if options.hist:
+        plot_hist(rtts)
+
+
+
 def statsparser(pipe, ns, slottimes=None):
-    hphelper.set_affinity('parser')
+    hphelper.set_affinity('statsparser', 'parser')
     DEBUG('starting parser ', __name__)
 
     #block until sender + receiver say they are ready
-    while not all([ns.RCV_READY,ns.SND_READY]):
-        time.sleep(0.1)
+    ns.wait_ready()
 
     stats = hphelper.stats_stats()
 
@@ -52,32 +67,28 @@ def statsparser(pipe, ns, slottimes=None):
     run_start = time.time()
     while 1:
         try:
-            data = pipe.recv()
-            if data == 'RCV_DONE':
+            recs = hphelper.recv_batch(pipe)
+            if recs is None:
                 break
 
-            (seq, currslot, rtt) = data
-            if currslot == -1:
-                 rtt = -1
-                 stats.snd_err += 1
-                 continue
-
-            stats.update(seq, rtt, currslot)
+            seq = recs['seq']
+            rtt = recs['rtt']
+            stats.update_batch(seq, rtt, recs['slot'])
 
-            if rtt<stats.min_rtt:
-                stats.min_rtt = rtt
+            if rtt.min() < stats.min_rtt:
+                stats.min_rtt = rtt.min()
 
-            rtts[seq] = rtt
+            if options.continuous:
+                rtts[seq % len(rtts)] = rtt     # keep the RTTs of the last pnum probes
+            else:
+                seq = seq - options.seq0        # resumed runs start at seq0
+                valid = (seq >= 0) & (seq < len(rtts))  # sequence numbers beyond pnum are ignored
+                rtts[seq[valid]] = rtt[valid]
 
 
         except (KeyboardInterrupt) as e:
             print 'parser canceled'
-        except (ValueError) as e:
-            print e
-            print 'done writing'
-        except (IndexError) as e:
-            print e, seq
-            pass ### TODO last sequence number causes error
+            break
 
     # omit invalid rtts
     rtts = rtts[rtts!=-1]
@@ -89,16 +100,7 @@ def statsparser(pipe, ns, slottimes=None):
     # store mean RTT for use in other modules
     ns.mean_rtt = mean(rtts)
 
-    stats.append_stats(median=('RTT median','%.6f' % median(rtts)),
-                       std=('RTT std. dev.','%.6f' % std(rtts)),
-                       #min=('min RTT','%.6f' % min(rtts)),
-                       max=('RTT maximum','%.6f' % max(rtts)),
-                       )
-
-    stats.pprint()
-
-    if options.hist:
-        plot_hist(rtts)
+    rttreport(stats, rtts)
 
     return
 
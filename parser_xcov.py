@@ -4,12 +4,12 @@
 
 import os
 import sys
+import collections
 import pprint
 import logging
 import threading
 import time
 import subprocess
-from collections import deque
 
 
 
@@ -54,20 +54,33 @@ if not options.DEBUG:
 
 class XcovEst(object):
 
+    start = 0           # first slot covered by the estimate
+
     def __init__(self, max_lag):
         self.L = max_lag    # max covariance lag
         self._xc = zeros(self.L, dtype=int)
-        self.win = zeros(self.L, dtype=bool)
+        self._win = zeros(self.L, dtype=bool)   # circular buffer holding the last L values
+        self._head = self.L-1                   # index of the most recent value in _win
+        self._lead = []                         # slot positions of the busy probes within the first L slots
         self.probe_count = 0
         self.slot_count = 0
 
         #self.av_coeff = self.aggvar_coeff(self.L)
 
+    @property
+    def win(self):
+        """ return the sliding window ordered from the oldest to the
+        most recent value """
+        return roll(self._win, self.L-1-self._head)
+
     def append(self, x, zero_count = 0):
         """ Appends the last received probe to the sliding window win
             containing the last L values (lags) and adds the contents of win
             to the biased covariance vector xc.
 
+            The window is stored as a circular buffer with a moving
+            head index so that no memory is allocated per probe.
+
         Args:
 
             x: Contains the probe value which must be 0 or 1
@@ -79,15 +92,157 @@ class XcovEst(object):
         self.slot_count  += zero_count+1                # keep track of total number or counted slots (should be all)
         self.probe_count += x                           # increment counter for each was received probe (zero or one)
 
-        zero_count = min(self.L-1, zero_count)
+        L = self.L
+        win = self._win
+        zero_count = min(L-1, zero_count)
         #if zero_count<0: return                        # ERROR: negative slot increment - should not happen!
 
-        # shift window to the left (concatenate is faster than roll for shifting)
-        self.win = concatenate( (self.win[zero_count+1:], zeros(zero_count, dtype=bool), [bool(x)]) )           
+        # clear the zero_count slots following the head (these wrap
+        # around at most once) and advance the head to the new probe
+        start = self._head+1
+        end = start+zero_count
+        if end <= L:
+            win[start:end] = False
+        else:
+            win[start:] = False
+            win[:end-L] = False
+        head = end % L
+        win[head] = bool(x)
+        self._head = head
 
         # increment autocovariance (just for non-zero values of win and only if x=1)
+        # win[head] holds lag 0 which maps to _xc[L-1], i.e., the
+        # buffer is aligned with _xc after rotating it by L-1-head
         if x == 1:
-            self._xc[nonzero(self.win)] += x
+            xc = self._xc
+            xc[:L-1-head] += win[head+1:]
+            xc[L-1-head:] += win[:head+1]
+            if self.slot_count <= L:
+                self._lead.append(self.slot_count-1)
+
+    def _busy_slots(self):
+        # slot positions (0-based, ascending) of the busy probes within
+        # the last L slots
+        pos = self.slot_count-1 - (self.L-1 - nonzero(self.win)[0])
+        return pos[pos >= 0]
+
+    def _set_busy_slots(self, pos):
+        # rebuild the window so that it holds the busy probes at the
+        # given slot positions; the head maps to slot slot_count-1
+        self._win[:] = False
+        self._win[self.L-1 - (self.slot_count-1 - pos)] = True
+        self._head = self.L-1
+
+    def append_batch(self, x, zero_counts):
+        """ Appends an array of probes, each preceded by the
+        corresponding number of empty slots in zero_counts. Equivalent
+        to calling append() for each probe, but the pairs of busy
+        probes are counted with vectorized operations: in pass d the
+        lag between each new busy probe and the d-th busy probe before
+        it is counted, until all of these lags exceed L.
+        """
+        x = asarray(x).astype(bool)
+        steps = asarray(zero_counts, dtype=int)+1
+        if not len(steps): return
+
+        L = self.L
+        pos = self.slot_count-1 + cumsum(steps)   # slot positions of the new probes
+        if self.slot_count < L:
+            lead = pos[x]
+            self._lead.extend(lead[lead < L].tolist())
+        busy = concatenate((self._busy_slots(), pos[x]))
+        k = len(busy) - x.sum()                   # busy probes from previous batches
+        n = len(busy)
+
+        xc = self._xc
+        pending = []
+        npending = 0
+        d = 0
+        while 1:
+            j = k if k > d else d
+            if j >= n: break
+            lags = busy[j:] - busy[j-d:n-d]
+            lags = lags[lags < L]
+            if not len(lags): break
+            pending.append(lags)
+            npending += len(lags)
+            if npending >= L:
+                # lag l maps to _xc[L-1-l]
+                xc += bincount(concatenate(pending), minlength=L)[::-1]
+                pending = []
+                npending = 0
+            d += 1
+        if pending:
+            xc += bincount(concatenate(pending), minlength=L)[::-1]
+
+        self.slot_count = pos[-1]+1
+        self.probe_count += x.sum()
+        self._set_busy_slots(busy[busy > pos[-1]-L])
+
+    def merge(self, other):
+        """ Appends the estimate of the slots following those of this
+        estimate and returns self. The pairs of busy probes across the
+        boundary are counted from the window of this estimate and the
+        busy probes within the first L slots of other, so merging the
+        estimates of consecutive segments of a trace gives exactly the
+        estimate of a single pass. Merges of consecutive segments may
+        be reduced in any order; independent runs are merged as if they
+        were concatenated. """
+        L = self.L
+        if other.L != L:
+            raise ValueError('cannot merge estimates with different maximum lags')
+        S = self.slot_count
+        tail = self._busy_slots()
+        lead = asarray(other._lead, dtype=int) + S
+
+        # lag l between a busy probe of the tail and one of the lead
+        # maps to _xc[L-1-l]
+        if len(tail)*len(lead) <= 4*L:
+            lags = (lead[:,newaxis] - tail[newaxis,:]).ravel()
+            cross = bincount(lags[lags < L], minlength=L)
+        else:
+            # correlate the indicators of the last and the first L slots
+            nfft = 2**int(ceil(log2(2*L)))
+            a = zeros(nfft)
+            a[tail-(S-L)] = 1.0
+            b = zeros(nfft)
+            b[lead-S] = 1.0
+            c = rint(fft.irfft(conj(fft.rfft(a))*fft.rfft(b), nfft)).astype(int)
+            cross = zeros(L, dtype=int)
+            cross[1:] = c[nfft-L+1:]         # lag l has offset l-L
+        self._xc += other._xc + cross[::-1]
+
+        busy = concatenate((tail, asarray(other._busy_slots(), dtype=int) + S))
+        if S < L:
+            self._lead.extend(lead[lead < L].tolist())
+        self.slot_count = S + other.slot_count
+        self.probe_count += other.probe_count
+        self._set_busy_slots(busy[busy > self.slot_count-1-L])
+        return self
+
+    def state(self):
+        """ Returns a copy of the estimator state for checkpoints. The
+        window is stored as the slot positions of its busy probes. """
+        return {'L':self.L, 'xc':self._xc.copy(), 'busy':self._busy_slots(),
+                'lead':array(self._lead, dtype=int),
+                'probe_count':self.probe_count, 'slot_count':self.slot_count}
+
+    @classmethod
+    def from_state(cls, state):
+        """ Returns a new estimator holding a state returned by state() """
+        est = cls(int(state['L']))
+        est.load_state(state)
+        return est
+
+    def load_state(self, state):
+        """ Restores a state returned by state() """
+        if state['L'] != self.L:
+            ERROR('the checkpoint was saved with a different maximum lag (L=%d)' % state['L'])
+        self._xc[:] = state['xc']
+        self.probe_count = int(state['probe_count'])
+        self.slot_count = int(state['slot_count'])
+        self._set_busy_slots(state['busy'])
+        self._lead = state['lead'].tolist()
 
     def test(self, data=None):
         if data == None:
@@ -179,18 +334,265 @@ class XcovEst(object):
         s = '\t'.join(['%.6f' % i for i in self.xcov])
         return s
 
+
+class XcovEstSparse(XcovEst):
+    """A covariance estimator which stores the slot positions of the
+    busy probes inside the last L slots instead of the full 0/1
+    window. The cost of appending a busy probe is proportional to the
+    number of busy probes in the window rather than to L, which pays
+    off when the path is mostly idle."""
+
+    def __init__(self, max_lag):
+        XcovEst.__init__(self, max_lag)
+        self._win = None
+        self._busy = zeros(self.L, dtype=int)  # circular buffer of busy slot positions (ascending)
+        self._first = 0                         # index of the oldest busy position in _busy
+        self._k = 0                             # number of busy positions within the last L slots
+
+    @property
+    def busy(self):
+        """ return the slot positions of the busy probes within the
+        last L slots, oldest first """
+        return take(self._busy, arange(self._first, self._first+self._k), mode='wrap')
+
+    @property
+    def win(self):
+        w = zeros(self.L, dtype=bool)
+        lags = self.slot_count-1 - self.busy
+        w[self.L-1-lags[lags < self.L]] = True
+        return w
+
+    def append(self, x, zero_count = 0):
+        """ Appends the last received probe. Only busy probes (x=1)
+        are stored: expired positions are evicted from the front of
+        the index and _xc is incremented at the lags of the remaining
+        busy probes.
+
+        Args:
+
+            x: Contains the probe value which must be 0 or 1
+            zero_count: Specifies the number of empty time slots to
+            append before the current probe.
+
+        """
+        self.slot_count  += zero_count+1
+        self.probe_count += x
+
+        if x != 1: return
+
+        L = self.L
+        pos = self.slot_count-1
+        if pos < L:
+            self._lead.append(pos)
+        busy = self._busy
+        first = self._first
+        k = self._k
+
+        # evict busy probes that fell out of the L slot horizon
+        while k and busy[first] <= pos-L:
+            first += 1
+            if first == L: first = 0
+            k -= 1
+
+        busy[(first+k) % L] = pos
+        k += 1
+
+        # the busy probe at slot p has lag pos-p which maps to _xc[L-1-(pos-p)]
+        offset = L-1-pos
+        end = first+k
+        xc = self._xc
+        if end <= L:
+            xc[busy[first:end]+offset] += 1
+        else:
+            xc[busy[first:]+offset] += 1
+            xc[busy[:end-L]+offset] += 1
+
+        self._first = first
+        self._k = k
+
+    def _busy_slots(self):
+        return self.busy[self.busy > self.slot_count-1-self.L]
+
+    def _set_busy_slots(self, pos):
+        self._busy[:len(pos)] = pos
+        self._first = 0
+        self._k = len(pos)
+
+
+
+class XcovHorizon(XcovEst):
+    """A view of the estimator est restricted to about the last
+    horizon slots, used for continuous runs. The lag sums of est are
+    copied every horizon/epochs slots; subtracting the oldest retained
+    copy leaves the sums of all pairs whose later probe lies within
+    the last epochs complete epochs and the current one. The memory
+    needed is epochs+1 lag vectors, independent of the run length."""
+
+    def __init__(self, est, horizon, epochs=8):
+        self.est = est
+        self.L = est.L
+        self.horizon = horizon
+        self.epochs = epochs
+        self.epoch = max(1, horizon//epochs)
+        self._snaps = collections.deque()      # (lag sums, slot_count, probe_count) at epoch ends
+        self._base = (zeros(self.L, dtype=int), 0, 0)
+        self._next = self.epoch
+
+    @property
+    def _xc(self):
+        return self.est._xc - self._base[0]
+
+    @property
+    def slot_count(self):
+        return self.est.slot_count - self._base[1]
+
+    @property
+    def probe_count(self):
+        return self.est.probe_count - self._base[2]
+
+    @property
+    def start(self):
+        return self._base[1]
+
+    @property
+    def win(self):
+        return self.est.win
+
+    def update(self):
+        """ Copy the lag sums if an epoch is complete and drop the
+        oldest copy once the horizon is covered """
+        est = self.est
+        if est.slot_count < self._next: return
+        self._snaps.append((est._xc.copy(), est.slot_count, est.probe_count))
+        self._next = est.slot_count - est.slot_count % self.epoch + self.epoch
+        while len(self._snaps) > self.epochs:
+            self._base = self._snaps.popleft()
+
+    def append(self, x, zero_count = 0):
+        self.est.append(x, zero_count)
+        self.update()
+
+    def merge(self, other):
+        raise ValueError('estimates with a horizon cannot be merged')
+
+    def state(self):
+        snaps = list(self._snaps)
+        state = self.est.state()
+        state.update({'horizon':self.horizon, 'epochs':self.epochs, 'next':self._next,
+                      'base_xc':self._base[0], 'base_counts':self._base[1:],
+                      'snap_xc':array([x for (x, sl, p) in snaps]).reshape(-1, self.L),
+                      'snap_counts':array([(sl, p) for (x, sl, p) in snaps]).reshape(-1, 2)})
+        return state
+
+    def load_state(self, state):
+        if state.get('horizon') != self.horizon or state['epochs'] != self.epochs:
+            ERROR('the checkpoint was saved with a different horizon')
+        self.est.load_state(state)
+        self._next = int(state['next'])
+        self._base = (state['base_xc'],) + tuple(asarray(state['base_counts']).tolist())
+        self._snaps = collections.deque([(x, int(sl), int(p)) for (x, (sl, p)) in
+                                         zip(state['snap_xc'], state['snap_counts'])])
+
+    def append_batch(self, x, zero_counts):
+        self.est.append_batch(x, zero_counts)
+        self.update()
+
+    @property
+    def xcov(self):
+        """ As XcovEst.xcov, but each slot of the horizon pairs with
+        the slot lag slots before it, even if that one lies before the
+        horizon """
+        N_unbiased = minimum(self.slot_count, self.est.slot_count - arange(self.L, dtype=float))
+        N_unbiased[N_unbiased < 1] = nan
+        return self.xc*1.0/N_unbiased - self.mean**2
+
+
+
+def xcov_fft(x, zero_counts, max_lag, sparse=False):
+    """Returns a covariance estimator in the same state as one fed
+    with append(x[i], zero_counts[i]) for all probes. The slot indexed
+    0/1 series is rebuilt and its lag sums are computed with a
+    zero-padded FFT at O(N log N) for N slots instead of O(N L).
+
+    The sums are integers, so rounding the FFT result reproduces the
+    counts of XcovEst exactly (xcov, mean and N_unbiased included).
+    """
+    est = XcovEstSparse(max_lag) if sparse else XcovEst(max_lag)
+    x = asarray(x).astype(bool)
+    pos = cumsum(asarray(zero_counts, dtype=int)+1) - 1   # slot positions of the probes
+    if not len(pos): return est
+
+    L = est.L
+    S = int(pos[-1])+1
+    busy = pos[x]
+
+    # pad to at least S+L-1 points so that lags below L do not wrap
+    nfft = 2**int(ceil(log2(S+L)))
+    y = zeros(nfft)
+    y[busy] = 1.0
+    Y = fft.rfft(y)
+    del y
+    ac = fft.irfft(Y.real**2 + Y.imag**2, nfft)[:L]
+
+    est._xc[:] = rint(ac)[::-1]
+    est.slot_count = S
+    est.probe_count = len(busy)
+    est._set_busy_slots(busy[busy > S-1-L])
+    est._lead = busy[busy < L].tolist()
+    return est
+
+
+
+def benchmark(L=10000, n=20000, ratios=(0.01, 0.1, 0.5, 0.9), rate=0.1):
+    """Compares the throughput of the dense and the sparse covariance
+    estimators for different ratios of busy probes."""
+    timetime = time.time
+
+    for r in ratios:
+        x = (random.rand(n) < r).astype(int)
+        z = random.geometric(rate, size=n)-1
+
+        res = []
+        for est in (XcovEst(L), XcovEstSparse(L)):
+            append = est.append
+            t = timetime()
+            for i in xrange(n):
+                append(x[i], z[i])
+            res.append((n/(timetime()-t), est))
+
+        if not all(res[0][1]._xc == res[1][1]._xc):
+            ERROR('sparse and dense estimates differ')
+        hphelper.INFO('busy ratio %.2f (L=%d)' % (r, L),
+                      'dense: %8.0f probes/s   sparse: %8.0f probes/s' % (res[0][0], res[1][0]))
+
+
 class XcovEstimator(threading.Thread):
     """An online estimator for the covariance of a point process.
 
     The object is fed samples using the append() function. It
     maintains a sliding window self.win and adds its values to self.xc
-    at each time-step.
+    at each time-step. With a horizon (in slots, default:
+    options.horizon in continuous mode) self.xc only covers about the
+    last horizon slots, while self.est holds the estimate of the whole
+    run. The horizon is used in continuous mode and with --track.
     """
 
-    def __init__(self, buf, slots):
+    def __init__(self, buf, slots, sparse=None, progress=True, horizon=None):
             self.stats = hphelper.stats_stats()
 
-            self.xc = XcovEst(options.L)
+            if sparse is None:
+                sparse = options.xc_sparse
+            if sparse:
+                # only store the positions of busy probes
+                self.est = XcovEstSparse(options.L)
+            else:
+                self.est = XcovEst(options.L)
+            if horizon is None:
+                horizon = options.horizon if (options.continuous or options.track) else 0
+            if horizon:
+                self.xc = XcovHorizon(self.est, horizon, options.epochs)
+            else:
+                self.xc = self.est
             self.L = self.xc.L            # max covariance lag
 
             self.buf = buf
@@ -199,13 +601,18 @@ class XcovEstimator(threading.Thread):
             self.min_win_seq = 1
             self.max_win_seq = self.L
 
+            self.last_seq = -1            # position of the run, see state()
+            self.last_slot = 0
+            self.ckpt = None
+
             self.terminated = False
 
             self.mean_a = options.rate
             self.var_a = self.mean_a - self.mean_a**2
 
             # start progress bar thread 
-            hphelper.bar_init(options, self.stats)
+            if progress:
+                hphelper.bar_init(options, self.stats)
 
             threading.Thread.__init__(self)
 
@@ -274,6 +681,44 @@ class XcovEstimator(threading.Thread):
         else:
             return None
 
+    def append_batch(self, x, zero_counts):
+        """Appends an array of probes (see XcovEst.append_batch)"""
+        self.xc.append_batch(x, zero_counts)
+
+    def update(self):
+        """Retires the oldest epoch if the horizon is covered (see
+        XcovHorizon.update)"""
+        if self.xc is not self.est:
+            self.xc.update()
+
+    def state(self):
+        """Returns a copy of the estimator state and of the position
+        of the run (last sequence and slot number) for checkpoints"""
+        state = self.xc.state()
+        state.update({'seq':self.last_seq, 'slot':self.last_slot, 'min_rtt':options.min_rtt})
+        state.update(self.stats.state())
+        return state
+
+    def load_state(self, state):
+        """Restores a state returned by state()"""
+        self.xc.load_state(state)
+        self.last_seq = int(state['seq'])
+        self.last_slot = int(state['slot'])
+        self.stats.load_state(state)
+
+    def total(self):
+        """Returns an estimator without horizon sharing the estimate
+        of the whole run (self.est)"""
+        xc = XcovEstimator(None, self.slots, progress=False, horizon=0)
+        xc.est = xc.xc = self.est
+        xc.stats = self.stats
+        return xc
+
+    def window(self):
+        """Returns the first slot, the number of slots and the number
+        of busy probes covered by the estimate"""
+        return (self.xc.start, self.xc.slot_count, self.xc.probe_count)
+
     def hurst(self, d=None, thresh=0):
         """Returns the Hurst parameter estimate."""
         if not d:
@@ -289,66 +734,80 @@ class XcovEstimator(threading.Thread):
 
     def run(self):
         stats = self.stats
-        last_seq = -1                                  # store maximum sequence number received until now
-        last_slot = 0
+        last_seq = self.last_seq                       # store maximum sequence number received until now
+        last_slot = self.last_slot
 
         if options.min_rtt == -1.0:
             min_rtt = inf
         else:
             min_rtt = options.min_rtt
 
+        # sequence and slot numbers wrap around in continuous runs
+        seqs = hphelper.counter32(last_seq+1)
+        slots = hphelper.counter32(last_slot)
+        append = self.est.append
+        self.ckpt = ckpt = hphelper.checkpointer(options.savefile + '.ckpt', options.checkpoint)
         
+        get_batch = self.buf.get_batch
         while 1:
-            try:  # TODO get rid of try block
-                (seq, slot, rtt) = self.buf.popleft()
-            except IndexError:
-                continue                             # loop until buffer is not empty
+            batch = get_batch()                          # block until records are available
+            if batch is None: break
+            batch = (seqs.unwrap(batch[0]), slots.unwrap(batch[1]), batch[2])
 
-            if seq == -2: break
+            for (seq, slot, rtt) in zip(*[a.tolist() for a in batch]):
+                stats.update(seq, rtt, slot)
 
-            stats.update(seq, rtt, slot)
+                if seq!=last_seq+1:
+                    # unexpected sequence number 
+                    seq_delta = seq-last_seq-1
+                    if seq_delta<0:
+                        # discard probe if it was received out of order
+                        # seq_delta == -1 --> duplicate packet
+                        stats.rx_out_of_order += 1
+                        continue
 
-            if seq!=last_seq+1:
-                # unexpected sequence number 
-                seq_delta = seq-last_seq-1
-                if seq_delta<0:
-                    # discard probe if it was received out of order
-                    # seq_delta == -1 --> duplicate packet
-                    stats.rx_out_of_order += 1
-                    continue
+                    # all intermediate packets were missing
+                    stats.rcv_err += seq_delta
 
-                # all intermediate packets were missing
-                stats.rcv_err += seq_delta
+                ## each dropped probe indicates a full queue append, a
+                ## 1 to the covariance vector
+                #while seq!=last_seq+1:
+                #    last_seq += 1
+                #    next_slot = slots[last_seq]
+                #    if next_slot==-1:                         # slottimes vector might be incomplete
+                #        continue
+                #    slot_delta = next_slot - last_slot
+                #    last_slot = next_slot
+                #    stats.rcv_err += 1                        # increment dropped packets counter
+                #    self.append(1, slot_delta)
 
-            ## each dropped probe indicates a full queue append, a
-            ## 1 to the covariance vector
-            #while seq!=last_seq+1:
-            #    last_seq += 1
-            #    next_slot = slots[last_seq]
-            #    if next_slot==-1:                         # slottimes vector might be incomplete
-            #        continue
-            #    slot_delta = next_slot - last_slot
-            #    last_slot = next_slot
-            #    stats.rcv_err += 1                        # increment dropped packets counter
-            #    self.append(1, slot_delta)
 
+                last_seq = seq
 
-            last_seq = seq
+                slot_delta = slot - last_slot
+                last_slot = slot
 
-            slot_delta = slot - last_slot
-            last_slot = slot
+                # check if the probe saw a busy period (True/False)
+                probe = rtt > min_rtt
 
-            # check if the probe saw a busy period (True/False)
-            probe = rtt > min_rtt
+                append(probe, slot_delta-1)
 
-            self.xc.append(probe, slot_delta-1)
+            self.update()
+
+            if ckpt.due():
+                (self.last_seq, self.last_slot) = (last_seq, last_slot)
+                ckpt.put(self.state())
+
+        (self.last_seq, self.last_slot) = (last_seq, last_slot)
+        if options.checkpoint:
+            ckpt.close(self.state())
 
 
 
 try:
     # try to bind cython methods
     # http://wiki.cython.org/FAQ#HowdoIimplementasingleclassmethodinaCythonmodule.3F
-    XcovEstimator.append = types.MethodType(hpfast.xc_append_f, None, XcovEstimator) 
+    XcovEst.append = types.MethodType(hpfast.xc_append_f, None, XcovEst) 
     XcovEstimator.xcov = types.MethodType(hpfast.xcov2_f, None, XcovEstimator) 
     min = hpfast.min
     max = hpfast.max 
@@ -361,24 +820,44 @@ except (NameError, AttributeError) as e:
 
 
 
+def xcsave(xc):
+    """Print the Hurst parameter estimate and save the covariance
+    to options.savefile + '.dat'"""
+    if xc.xc is not xc.est and not options.continuous:
+        # the horizon only applies to the published and tracked rows
+        xc = xc.total()
+    (d,y0) = xc.fit()
+    print
+    print "\tH=%.2f (slope %.4f y0=%.4f)" % ((d+2)/2, d, y0 )
+    print 
+
+
+    fname = options.savefile + '.dat'
+    print "saving covariance to " + fname + " ..."
+    try:
+        fs = open(fname, mode='w')
+        fs.write('% ' + options.IPDST + ' ' + str(options))
+        
+        for j in xc.xc.xcov[1:]:
+            fs.write("%e\n" % (j))
+        fs.close()
+    except KeyboardInterrupt:
+            print 'canceled saving.'
+
+
+
 def xcparser(pipe, ns, slottimes):
-    if not options.start_time:
-        options.start_time = time.time()
-  
-    if not options.savefile:
-        # default save name is destination + YYMMDD + HHMM
-        options.savefile = options.DST + time.strftime("_%Y%m%d_%H%M", 
-                                                       time.localtime(options.start_time)) 
-    options.savefile += options.tag 
-    options.savefile += '_xc'
+    hphelper.init_savefile('_xc')
 
     timetime = time.time          # faster: http://wiki.python.org/moin/PythonSpeed/PerformanceTips
-    hphelper.set_affinity('parser') 
+    hphelper.set_affinity('xcparser', 'parser')
 
-    rcv_buf = deque() # TODO  rcv_buf = xcfast.fixed_buf(options.pnum)
+    rcv_buf = hphelper.batch_buf()
 
     xc = XcovEstimator(rcv_buf, slottimes)
     xc.daemon = True
+    if options.resume:
+        hphelper.resume_state(xc)
     xc.name='parseloop'
 
 
@@ -387,28 +866,28 @@ def xcparser(pipe, ns, slottimes):
     xcplotter_thread.daemon = True
 
     #block until sender + receiver say they are ready
-    while not all([ns.RCV_READY,ns.SND_READY]):
-        time.sleep(0.1)
+    ns.wait_ready()
 
     DEBUG('starting parser: '+__name__)
     xc.stats.run_start = timetime()
 
     xcplotter_thread.start()
     xc.start()
+    if (options.continuous or options.track) and options.publish:
+        publisher = threading.Thread(target=hphelper.publish_hurst, args=(xc, 'xcov', options.publish))
+        publisher.daemon = True
+        publisher.start()
 
 
-    data = None
     try:
         while 1:                              # faster than while True
-            data = pipe.recv()                # get (seq, slot, rtt) from capture process
-            (seq, slot, rtt) = data
-            rcv_buf.append((seq, slot, rtt))   
+            recs = hphelper.recv_batch(pipe)  # get (seq, slot, rtt) records from capture process
+            if recs is None: break
+            rcv_buf.extend(recs)
+        print '\a', # all packets received
     except (KeyboardInterrupt):
-        rcv_buf.append((-2,-2,-2))
         print '\n\nparse loop interrupted...'
-    except (ValueError) as e:
-        rcv_buf.append((-2,-2,-2))
-        print '\a', # all packets received
+    rcv_buf.close()
 
     try:
         xc.join()
@@ -419,27 +898,11 @@ def xcparser(pipe, ns, slottimes):
 
     # display statistics
     xc.stats.run_end = timetime()
-    xc.stats.rx_slots = xc.xc.slot_count
+    xc.stats.rx_slots = xc.est.slot_count
     xc.stats.pprint()
+    xc.ckpt.pprint()
 
-
-    (d,y0) = xc.fit()
-    print
-    print "\tH=%.2f (slope %.4f y0=%.4f)" % ((d+2)/2, d, y0 )
-    print 
-
-
-    fname = options.savefile + '.dat'
-    print "saving covariance to " + fname + " ..."
-    try:
-        fs = open(fname, mode='w')
-        fs.write('% ' + options.IPDST + ' ' + str(options))
-        
-        for j in xc.xc.xcov[1:]:
-            fs.write("%e\n" % (j))
-        fs.close()
-    except KeyboardInterrupt:
-            print 'canceled saving.'
+    xcsave(xc)
 
 
 
@@ -522,3 +985,8 @@ def xcplotter(xc, gp=None):
         gp_cmd("plot '-' with points ls 3\n %s\n e"  % ydata)
 
     gp.quit()
+
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,204 @@
+# Copyright 2014 IKT Leibniz Universitaet Hannover
+# GPL2
+# Zdravko Bozakov (zb@ikt.uni-hannover.de)
+
+import mmap
+import select
+import socket
+import struct
+import time
+
+import numpy as np
+
+import hphelper
+
+
+options = hphelper.options
+DEBUG = hphelper.DEBUG
+INFO = hphelper.INFO
+WARN = hphelper.WARN
+ERROR = hphelper.err
+
+
+# linux/if_packet.h
+SOL_PACKET        = 263
+PACKET_RX_RING    = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION    = 10
+TPACKET_V3        = 2
+TP_STATUS_KERNEL  = 0
+TP_STATUS_USER    = 1
+PACKET_OUTGOING   = 4
+ETH_P_ALL         = 0x0003
+
+TPACKET3_HDRLEN   = 48          # TPACKET_ALIGN(sizeof(struct tpacket3_hdr))
+
+# offsets of the probe fields in the captured Ethernet frame
+OFF_ETHTYPE = 12
+OFF_PROTO   = 23
+OFF_SRC     = 26
+OFF_DST     = 30
+OFF_TYPE    = 34                # ICMP type
+OFF_SEQ     = 50                # ICMP (offset 34) + 16
+OFF_SLOT    = 54
+PROBE_MIN_LEN = 58
+
+
+def _be32(buf, idx):
+    # big endian uint32 at the byte offsets idx of the uint8 array buf
+    return ((buf[idx].astype(np.uint32) << 24) | (buf[idx+1].astype(np.uint32) << 16) |
+            (buf[idx+2].astype(np.uint32) << 8) | buf[idx+3])
+
+
+class packet_ring(object):
+    """ Capture the probes on a memory-mapped TPACKET_V3 receive ring
+    of an AF_PACKET socket (Linux only). The kernel fills whole blocks
+    of frames which are parsed at once; blocks are retired after
+    retire_ms even if they are not full. Only ICMP echo requests sent
+    to ip and echo replies received from ip are returned (all ICMP
+    echo packets if ip is None). """
+
+    def __init__(self, eth, ip=None, block_size=2**20, block_nr=32, frame_size=2**11, retire_ms=10):
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        self.sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        req = struct.pack('IIIIIII', block_size, block_nr, frame_size, block_size*block_nr//frame_size,
+                          retire_ms, 0, 0)
+        self.sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        self.sock.bind((eth, ETH_P_ALL))
+
+        self.ring = mmap.mmap(self.sock.fileno(), block_size*block_nr,
+                              mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.buf = np.frombuffer(self.ring, dtype=np.uint8)
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.block = 0                  # next block to be read
+        self.ip = None
+        if ip is not None:
+            self.ip = np.frombuffer(socket.inet_aton(ip), dtype=np.uint8)
+
+        self.poll = select.poll()
+        self.poll.register(self.sock.fileno(), select.POLLIN | select.POLLERR)
+        self.packets = 0
+        self.drops = 0
+        self.blocks_read = 0
+
+    def stats(self):
+        """ Add the kernel packet and drop counters (reset when read) """
+        (packets, drops, freeze) = struct.unpack('III', self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+        self.packets += packets
+        self.drops += drops
+        return (self.packets, self.drops)
+
+    def _read_block(self, blk):
+        # walk the frames of the block, then gather the fields of all frames at once
+        (num_pkts, first) = struct.unpack_from('II', self.ring, blk+12)
+        unpack_from = struct.unpack_from
+        ring = self.ring
+        offs = np.empty(num_pkts, dtype=np.int64)
+        p = blk + first
+        for k in xrange(num_pkts):
+            offs[k] = p
+            p += unpack_from('I', ring, p)[0]
+
+        buf = self.buf
+        hdr = offs//4
+        u32 = buf.view(np.uint32)
+        sec = u32[hdr+1]
+        nsec = u32[hdr+2]
+        snaplen = u32[hdr+3]
+        mac = offs + buf.view(np.uint16)[(offs+24)//2]
+        outgoing = buf[offs+TPACKET3_HDRLEN+10] == PACKET_OUTGOING   # sockaddr_ll.sll_pkttype
+
+        ok = snaplen >= PROBE_MIN_LEN
+        (mac, sec, nsec, outgoing) = (mac[ok], sec[ok], nsec[ok], outgoing[ok])
+        icmp_type = buf[mac+OFF_TYPE]
+        ok = ((buf[mac+OFF_ETHTYPE] == 0x08) & (buf[mac+OFF_ETHTYPE+1] == 0x00) &
+              (buf[mac+OFF_PROTO] == 1) & ((icmp_type == 8) | (icmp_type == 0)))
+        if self.ip is not None:
+            # requests to the destination, replies from the destination
+            peer = np.where(icmp_type == 8, mac+OFF_DST, mac+OFF_SRC)
+            for i in xrange(4):
+                ok &= buf[peer+i] == self.ip[i]
+        mac = mac[ok]
+        return (icmp_type[ok], _be32(buf, mac+OFF_SEQ), _be32(buf, mac+OFF_SLOT),
+                sec[ok] + nsec[ok]*1e-9, outgoing[ok])
+
+    def blocks(self, timeout_ms=3000):
+        """ Generator returning arrays (icmp_type, seq, slot, timestamp,
+        outgoing) for each block of frames filled by the kernel. Stops
+        if no block is filled within timeout_ms. """
+        while 1:
+            blk = self.block*self.block_size
+            if not (struct.unpack_from('I', self.ring, blk+8)[0] & TP_STATUS_USER):
+                if not self.poll.poll(timeout_ms):
+                    return
+                continue
+            recs = self._read_block(blk)
+            struct.pack_into('I', self.ring, blk+8, TP_STATUS_KERNEL)   # hand block back to the kernel
+            self.block = (self.block + 1) % self.block_nr
+            self.blocks_read += 1
+            yield recs
+
+    def close(self):
+        self.stats()
+        del self.buf
+        self.ring.close()
+        self.sock.close()
+
+    def pprint(self):
+        INFO('ring blocks read', self.blocks_read)
+        INFO('ring packets', self.packets)
+        if self.drops:
+            WARN('WARNING', 'kernel dropped %d packets (%.2f%%)' % (self.drops, self.drops*100.0/max(self.packets, 1)))
+        else:
+            INFO('ring drops', 0)
+
+
+
+def test_frame(icmp_type, seq, slot, ip='127.0.0.1'):
+    """ Builds an ICMP echo frame carrying seq and slot as the probes
+    do. The IP checksum is left 0 so the frame is not answered by the
+    kernel. """
+    ip = socket.inet_aton(ip)
+    return (''.join(['\0'*12, '\x08\x00',                          # Ethernet
+                     '\x45\0\0\x56\0\0\0\0\x40\x01\0\0', ip, ip,     # IP
+                     chr(icmp_type), '\0'*3, 'abcdefghijkl',          # ICMP
+                     struct.pack('!LL', seq, slot), 'H'*42]))
+
+
+def test_ring(n=10**5, eth='lo', block_nr=32):
+    """ Sends n echo requests and replies on the loopback interface,
+    captures them on the ring and checks that every probe is matched.
+    Reports the capture throughput and the kernel drops (try a small
+    block_nr to provoke drops). Requires root. """
+    import transmit
+    ring = packet_ring(eth, '127.0.0.1', block_nr=block_nr)
+    tx = transmit.tx_packet(eth)
+    s_times = -np.ones(n)
+    matched = np.zeros(n, dtype=bool)
+
+    def match(timeout_ms):
+        for (icmp_type, seq, slot, ts, outgoing) in ring.blocks(timeout_ms):
+            req = (icmp_type == 8) & outgoing
+            s_times[seq[req]] = ts[req]
+            rep = (icmp_type == 0) & ~outgoing
+            rep[rep] = s_times[seq[rep]] != -1
+            matched[seq[rep]] = slot[rep] == 2*seq[rep]
+
+    t = time.time()
+    size = 2**12
+    for i in xrange(0, n, size):
+        frames = []
+        for seq in xrange(i, min(i+size, n)):
+            frames += [test_frame(8, seq, 2*seq), test_frame(0, seq, 2*seq)]
+        for j in xrange(0, len(frames), tx.max_batch):
+            tx.send_many(frames[j:j+tx.max_batch])
+        match(0)                        # read the blocks which are already filled
+    tx.close()
+    match(100)
+    t = time.time()-t
+    ring.close()
+    ring.pprint()
+    INFO('matched probes', '%d of %d' % (matched.sum(), n))
+    INFO('send and capture', '%.0f frames/s' % (ring.packets/t))
+    return matched.sum()
@@ -2,15 +2,20 @@
 # GPL2
 # Zdravko Bozakov (zb@ikt.uni-hannover.de)
 
-import array
+import ctypes
+import ctypes.util
 import dpkt
 import logging
+import os
+import Queue
 import socket
 import struct
 import sys
+import threading
 import time
 
 import hphelper
+import transmit
 
 try:
     import dnet               # OSX: brew install libdnet --with-python
@@ -32,23 +37,21 @@ except ImportError:
     print "\tpython-numpy"
     exit(1)
 
-# pcap versions with different methods for injecting packets exist            
-if hasattr(pcap.pcap, 'inject'):
-    # ubuntu (python-pcap)
-    PCAP_INJECT = True
-else:
-    # use pcap.sendpacket instead
-    PCAP_INJECT = False
-
 try:
   import setproctitle
   setproctitle.setproctitle('h-probe')
 except:
   pass # Ignore errors, since this is only cosmetic
 
+try:
+    # import cython functions if available
+    import hpfast
+except (ImportError, ValueError) as e:
+    pass
+
 
 options = hphelper.options
-from hphelper import DEBUG, INFO, ERROR, set_affinity 
+from hphelper import DEBUG, INFO, WARN, ERROR, set_affinity 
 
 
 IP_HDR_LEN    = 20
@@ -63,11 +66,9 @@ def checksum(packet):
 
     if len(packet) & 1:                 # any data?
         packet = packet + '\0'          # make null
-    words = array.array('h', packet)    # make a signed short array of packet
-    sum = 0
+    words = np.frombuffer(packet, dtype=np.uint16)  # native 16 bit words of packet
+    sum = int(words.sum(dtype=np.uint64))
 
-    for word in words:
-        sum = sum + (word & 0xffff)     # bitwise AND
     hi = sum >> 16                      # bitwise right-shift
     lo = sum & 0xffff                   # bitwise AND
     sum = hi + lo
@@ -77,82 +78,219 @@ def checksum(packet):
 
 
 
+def _monotonic_clock():
+    # clock_gettime(CLOCK_MONOTONIC) through ctypes. The timespec is
+    # shared, so the clock must only be used by a single thread.
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    ts = timespec()
+    ts_ref = ctypes.byref(ts)
+    clk_id = 6 if sys.platform == 'darwin' else 1
+
+    def monotonic():
+        clock_gettime(clk_id, ts_ref)
+        return ts.tv_sec + ts.tv_nsec*1e-9
+    return monotonic
+
+try:
+    monotonic = hpfast.monotonic
+except (NameError, AttributeError):
+    monotonic = _monotonic_clock()
+
+
+
+class send_error_hist(object):
+    """ Histogram of the differences between the actual and the
+    scheduled send times of the probes. Probes sent later than one slot
+    (delta) break the assumption that the probes are sent at
+    geometrically distributed slots. """
+
+    EDGES = np.array([0, 1e-6, 2e-6, 5e-6, 1e-5, 2e-5, 5e-5, 1e-4, 2e-4, 5e-4,
+                      1e-3, 2e-3, 5e-3, 1e-2, np.inf])
+
+    def __init__(self, delta):
+        self.delta = delta
+        self.counts = np.zeros(len(self.EDGES)-1, dtype=int)
+        self.n = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.late = 0                   # probes sent more than a slot late
+
+    def add(self, err):
+        """ Add an array of send time errors in seconds """
+        if not len(err): return
+        idx = np.searchsorted(self.EDGES, err, side='right')-1
+        self.counts += np.bincount(idx.clip(0, len(self.counts)-1), minlength=len(self.counts))
+        self.n += len(err)
+        self.sum += err.sum()
+        self.max = max(self.max, err.max())
+        self.late += np.sum(err > self.delta)
+
+    def pprint(self):
+        if not self.n: return
+        INFO('send time error', 'mean %.1f us, max %.1f us' % (self.sum/self.n*1e6, self.max*1e6))
+        for (i, c) in enumerate(self.counts):
+            if not c: continue
+            INFO('  %g - %g us' % (self.EDGES[i]*1e6, self.EDGES[i+1]*1e6), '%d (%.2f%%)' % (c, c*100.0/self.n))
+        if self.late:
+            WARN('WARNING', '%d probes (%.2f%%) were sent more than one slot late' % (self.late, self.late*100.0/self.n))
+
+
+
+def paced_send(tx, pkts, times, errs, i0=0, spin=2e-4, payload=''):
+    """ Sends pkts[i]+payload over the transmit backend tx at the
+    monotonic clock time times[i] for i >= i0 and stores the difference
+    between the actual and the scheduled send time in errs[i]. The
+    sender sleeps until spin seconds before the send time and
+    busy-waits for the rest, which avoids overshooting by the scheduler
+    granularity. If the sender is late, all packets which are due are
+    passed to tx.send_many at once (up to tx.max_batch). """
+    clock = monotonic
+    time_sleep = time.sleep
+    send = tx.send
+    max_batch = tx.max_batch
+    n = len(pkts)
+    i = i0
+    while i < n:
+        pkt = ''.join([pkts[i],payload])                    # append payload 
+        t = times[i]
+        now = clock()
+        if t - now > spin:
+            time_sleep(t - now - spin)                      # coarse sleep
+            now = clock()
+        while now < t:                                      # spin for the rest
+            now = clock()
+        errs[i] = now - t
+
+        j = i+1
+        if max_batch > 1:
+            while j < n and j-i < max_batch and times[j] <= now:
+                errs[j] = now - times[j]
+                j += 1
+        if j == i+1:
+            send(pkt)
+        else:
+            tx.send_many([pkt] + [''.join([pkts[k],payload]) for k in xrange(i+1, j)])
+        i = j
+
+
+
 def dummyloop(ns):
     # notify receiver that we are ready to send
     ns.SND_READY=True
     # block until receiver says it is ready
-    while not ns.RCV_READY:
-        time.sleep(0.1)
+    ns.wait_ready(snd=False)
 
     DEBUG('READY', __name__)
 
 
+def open_tx(calibration=False):
+    """ Opens the transmit backend selected by options.tx in the
+    sending process, so the calibration and the measurement run do not
+    share a descriptor. With --tx=file the calibration run writes to
+    its own file, TX_FILE with '_cal' appended to the name. """
+    fname = TX_FILE
+    if fname and calibration:
+        (root, ext) = os.path.splitext(fname)
+        fname = root + '_cal' + ext
+    return transmit.open_tx(options.tx, options.net_info['eth'], fname)
+
+
 ################################################################################
 def sendloop(ns, busy_loop=False):
-
-    geotimes = options.delta*slottimes
+    t_init = monotonic()
 
     set_affinity('sendloop') 
 
-    time_time  = time.time          # faster: http://wiki.python.org/moin/PythonSpeed/PerformanceTips
-    time_sleep = time.sleep
+    spin = options.spin
+    if busy_loop:
+        spin = np.inf
 
  
     if ns.cnum:
         pnum = ns.cnum
+    elif options.continuous:
+        pnum = None
+        INFO('continuous probing', 'press Ctrl-C to stop (mean inter-probe time %.2e s)' % (options.delta/options.rate))
     else:
-        pnum = options.pnum
-        INFO('expected run time', '~%.2f s (mean inter-probe time %.2e s)' % (geotimes[-1], options.delta/options.rate))
-        if geotimes[-1]/60/60>4:
+        pnum = options.pnum - options.seq0      # a resumed run sends the remaining probes
+        t_run = pnum*options.delta/options.rate
+        INFO('expected run time', '~%.2f s (mean inter-probe time %.2e s)' % (t_run, options.delta/options.rate))
+        if t_run/60/60>4:
             WARN('WARNING', 'stationarity may not hold!')
 
+    # the same sequence of slots is sent in each run; a resumed run
+    # continues after the last probe of the checkpoint
+    if ns.cnum:
+        stream = probe_stream(PROBE_TEMPLATE, pnum, seed=SLOT_SEED)
+    else:
+        stream = probe_stream(PROBE_TEMPLATE, pnum, seed=SLOT_SEED, seq0=options.seq0, slot0=options.slot0)
+    chunks = iter(stream)
+    (pkts, slots) = chunks.next()               # block until the first chunk is ready
+    try:
+        TX = open_tx(calibration=bool(ns.cnum))
+    except SystemExit:
+        ns.FATAL_ERROR = True           # the receiver and the parsers wait for the sender
+        raise
 
 
     # notify receiver that we are ready to send and block until
     # receiver process says it is ready
     ns.SND_READY=True
-    while not ns.RCV_READY:
-        time.sleep(0.1)
+    ns.wait_ready(snd=False)
 
     DEBUG('READY', __name__)
 
 
     payload_rest = '8'*PKT_ARRAY_APPEND
+    delta = options.delta
+    hist = send_error_hist(delta)
+    errs = np.zeros(len(pkts))
     try:
-        t_start = time_time()
-        geotimes += t_start
-        pkt = ''.join([pkts[0],payload_rest])
-        
-        if busy_loop==True:
-            for i in xrange(1,pnum):
-                sendpacket(pkt)
-                pkt = ''.join([pkts[i],payload_rest])    # append payload 
-                while (time_time() < geotimes[i]):
-                    pass
-        else:                                       
-            for i in xrange(1,pnum):
-                sendpacket(pkt)
-                pkt = ''.join([pkts[i],payload_rest])            # append payload 
-                time_sleep(np.max((geotimes[i]-time_time(),0.0)))  # reduce the load at the expence of accuracy    
-        sendpacket(pkt)                                 # send the last prepared packet
-
+        # the first probe is sent immediately
+        t_start = monotonic() - delta*slots[0]
+        TX.send(''.join([pkts[0],payload_rest]))
+        INFO('time to first probe', '%.3f s' % (monotonic()-t_init))
+        i0 = 1
+
+        while 1:
+            geotimes = (delta*slots + t_start).tolist()
+            paced_send(TX, pkts, geotimes, errs, i0, spin, payload_rest)
+            hist.add(errs[i0:len(pkts)])
+            i0 = 0
+            (pkts, slots) = chunks.next()            # generated while the last chunk was sent
+
+    except StopIteration:
+        pass
     except KeyboardInterrupt:
         pass
 
-    t_total = time_time() - t_start
+    t_total = monotonic() - t_start
+    TX.close()
 
     print '\a',  
-    #s.close()                 # close socket
     DEBUG("sender runtime:\t %.8f s" % (t_total))
+    hist.pprint()
+    TX.report(t_total)
 
 
 ##############################################################################
-# pre-generate probes on import
+# probe generation
+
 
+PKT_CHUNK = 2**16               # number of probes generated at once
 
-def gen_probes_raw():
-    """ Pre-generate raw Ethernet packets and store these in the 
-    array pkts.
+
+def probe_template():
+    """ Build the raw Ethernet packet of the probe with sequence and
+    slot number 0. Returns the packet split into its parts (see
+    probe_stream) and the initial ICMP checksum.
     """
     from dpkt.ethernet import Ethernet
     from dpkt.ip import IP
@@ -167,57 +305,196 @@ def gen_probes_raw():
         options.net_info['l2_dst'] = dnet.arp().get(options.net_info['ip_dst']).eth
 
 
-    try:
-        icmp_data = ICMP(type=8, data=ICMP.Echo(seq=0, id=0,data = 'H'*(options.plen-ICMP_HDR_LEN-IP_HDR_LEN)))
-        ip_data = IP(src=options.net_info['ip_src'].ip, dst=options.net_info['ip_dst'].ip, p=1, data=icmp_data)
-        ip_data.len += len(ip_data.data)
-
-        p0 = Ethernet(src=options.net_info['l2_src'], dst=options.net_info['l2_dst'], data=ip_data)
-        str_p = str(p0)
-
-        hdr = str_p[:ETHER_HDR_LEN+IP_HDR_LEN]
-        pkt = str_p[ETHER_HDR_LEN+IP_HDR_LEN:]
-        psize = options.plen + ETHER_HDR_LEN
-
-        # packet and format 
-        p = [ hdr, 
-              pkt[:2], 
-              struct.pack('<H', (0)),                           # p[2] = ICMP checksum
-              pkt[4:16], 
-              struct.pack('!L', (0) % 0xFFFFFFFF),              # p[4] = sequence number (4 bytes)
-              struct.pack('!L', (0) % 0xFFFFFFFF),              # p[5] = slot number (4 bytes)
-              pkt[16+4+4:]]                                     # payload
-
-        ck = checksum(''.join(p[1:])) & 0xFFFF                  # calculate initial ICMP cksum
-        p[2] = struct.pack('H', (ck))                           # update ICMP cksum
-
-        M_ = sum(struct.unpack('HHHH',''.join(p[4:6])))
-        j = 0
-        for i in xrange(options.pnum):
-            j=long(slottimes[i])
-            p[4] = struct.pack('!L', (i) % 0xFFFFFFFF)          # increment 4 byte seq ID in ICMP payload
-            p[5] = struct.pack('!L', (j) % 0xFFFFFFFF)          # increment 4 byte slot ID in ICMP payload
-            M = sum(struct.unpack('HHHH', ''.join(p[4:6])))
-            ck = ck + M_ - M
-
-            p[2] = struct.pack('H', (ck) % 0xFFFF)               # update ICMP cksum
-            pkts[i] = ''.join(p)[:PKT_ARRAY_WIDTH]                  # only store first 100 packet bytes 
-
-            M_=M
+    icmp_data = ICMP(type=8, data=ICMP.Echo(seq=0, id=0,data = 'H'*(options.plen-ICMP_HDR_LEN-IP_HDR_LEN)))
+    ip_data = IP(src=options.net_info['ip_src'].ip, dst=options.net_info['ip_dst'].ip, p=1, data=icmp_data)
+    ip_data.len += len(ip_data.data)
 
-    except (MemoryError, ValueError):
-        ERROR("Not enough memory!",2)
-    except KeyboardInterrupt:
-        print 'terminated by user.'
-        raise SystemExit(-1)
+    p0 = Ethernet(src=options.net_info['l2_src'], dst=options.net_info['l2_dst'], data=ip_data)
+    str_p = str(p0)
 
-    print 'done.'
-    try:
-        po = pcap.pcap(options.net_info['eth'])
-        return po
-    except Exception as e:
-        print e
+    hdr = str_p[:ETHER_HDR_LEN+IP_HDR_LEN]
+    pkt = str_p[ETHER_HDR_LEN+IP_HDR_LEN:]
+
+    # packet and format 
+    p = [ hdr, 
+          pkt[:2], 
+          struct.pack('<H', (0)),                           # p[2] = ICMP checksum
+          pkt[4:16], 
+          struct.pack('!L', (0) % 0xFFFFFFFF),              # p[4] = sequence number (4 bytes)
+          struct.pack('!L', (0) % 0xFFFFFFFF),              # p[5] = slot number (4 bytes)
+          pkt[16+4+4:]]                                     # payload
+
+    ck = checksum(''.join(p[1:])) & 0xFFFF                  # calculate initial ICMP cksum
+    p[2] = struct.pack('H', (ck))                           # update ICMP cksum
+    return (p, ck)
+
+
+
+class probe_stream(object):
+    """ Generates pnum probes with the sequence numbers seq0 to
+    seq0+pnum-1, or indefinitely if pnum is None, in chunks of size
+    probes. Each chunk holds the first PKT_ARRAY_WIDTH bytes of the
+    packets and their slot numbers; the slots following slot0 are
+    drawn from a geometric distribution (seeded by seed). Sequence and
+    slot numbers wrap around at 2**32.
 
+    Iterating over the stream starts a thread which generates the
+    next chunk while the current one is sent (double buffering), so
+    at most three chunks are held in memory regardless of pnum. The
+    ICMP checksum is updated incrementally from one probe to the next.
+    """
+
+    def __init__(self, template, pnum, size=PKT_CHUNK, seed=None, seq0=0, slot0=0):
+        (p, ck) = template
+        self.ck = ck
+        self.M_ = sum(struct.unpack('HHHH',''.join(p[4:6])))
+        self.end = None if pnum is None else seq0+pnum
+        self.size = size
+        self.rnd = np.random.RandomState(seed)
+        self.seq = seq0             # sequence number of the next probe
+        self.slot = slot0           # slot of the last probe
+
+        # byte offsets of the checksum and the seq/slot fields and the
+        # stored part of the template as a row of bytes
+        self.off_ck = len(''.join(p[:2]))
+        self.off_fields = len(''.join(p[:4]))
+        row = ''.join(p)[:PKT_ARRAY_WIDTH]
+        self.row = np.zeros(PKT_ARRAY_WIDTH, dtype=np.uint8)
+        self.row[:len(row)] = np.frombuffer(row, dtype=np.uint8)
+
+    def chunk(self):
+        """ Returns the packets and slot numbers of the next chunk. The
+        packets are written into a byte matrix with one row per probe:
+        the template is copied and the seq/slot fields and checksums
+        of all probes are set at once. """
+        n = self.size
+        if self.end is not None:
+            n = min(n, self.end-self.seq)
+        slots = self.slot + np.cumsum(self.rnd.geometric(options.rate, size=n))
+
+        fields = np.empty((n, 2), dtype='>u4')                  # 4 byte seq and slot IDs
+        fields[:,0] = (self.seq + np.arange(n)) & 0xFFFFFFFF     # wrap around at 2**32
+        fields[:,1] = slots & 0xFFFFFFFF
+        fields = fields.view(np.uint8).reshape(n, 8)
+
+        # the checksum changes by the difference between the sums of
+        # the (native) 16 bit words of the fields of consecutive probes
+        M = fields.view(np.uint16).sum(axis=1, dtype=np.int64)
+        ck = self.ck + self.M_ - M
+
+        pkts = np.empty(n, dtype=np.dtype((str, PKT_ARRAY_WIDTH)))
+        rows = pkts.view(np.uint8).reshape(n, PKT_ARRAY_WIDTH)
+        rows[:] = self.row
+        rows[:,self.off_ck:self.off_ck+2] = (ck % 0xFFFF).astype(np.uint16).view(np.uint8).reshape(n, 2)
+        rows[:,self.off_fields:self.off_fields+8] = fields
+
+        if n:
+            self.ck = int(ck[-1])
+            self.M_ = int(M[-1])
+            self.slot = slots[-1]
+        self.seq += n
+        return (pkts, slots)
+
+    def _run(self, q):
+        while self.end is None or self.seq < self.end:
+            q.put(self.chunk())
+        q.put(None)
+
+    def __iter__(self):
+        q = Queue.Queue(1)
+        t = threading.Thread(target=self._run, args=(q,))
+        t.daemon = True
+        t.start()
+        while 1:
+            chunk = q.get()
+            if chunk is None: break
+            yield chunk
+
+
+
+def test_template():
+    """ Returns a probe template with the layout of a 64 byte probe """
+    p = ['\x01'*(ETHER_HDR_LEN+IP_HDR_LEN), '\x08\0', '\0\0', 'abcdefghijkl', '\0'*4, '\0'*4, 'H'*20]
+    ck = checksum(''.join(p[1:])) & 0xFFFF
+    p[2] = struct.pack('H', (ck))
+    return (p, ck)
+
+
+def gen_probes_ref(template, slots):
+    """ Reference implementation of the probe generation: builds the
+    probes with the sequence numbers 0..len(slots)-1 one by one,
+    updating the ICMP checksum incrementally. """
+    (p, ck) = template
+    p = list(p)
+    pkts = np.empty(len(slots), dtype=np.dtype((str, PKT_ARRAY_WIDTH)))
+    M_ = sum(struct.unpack('HHHH',''.join(p[4:6])))
+    for i in xrange(len(slots)):
+        j=long(slots[i])
+        p[4] = struct.pack('!L', (i) & 0xFFFFFFFF)          # increment 4 byte seq ID in ICMP payload
+        p[5] = struct.pack('!L', (j) & 0xFFFFFFFF)          # increment 4 byte slot ID in ICMP payload
+        M = sum(struct.unpack('HHHH', ''.join(p[4:6])))
+        ck = ck + M_ - M
+
+        p[2] = struct.pack('H', (ck) % 0xFFFF)               # update ICMP cksum
+        pkts[i] = ''.join(p)[:PKT_ARRAY_WIDTH]              # only store first 100 packet bytes 
+
+        M_=M
+    return pkts
+
+
+def test_templating(pnum=10**5, size=PKT_CHUNK):
+    """ Compares the probes of probe_stream with gen_probes_ref and
+    reports the packets generated per second by both. """
+    template = test_template()
+    t = time.time()
+    chunks = list(probe_stream(template, pnum, size, seed=0))
+    t_stream = time.time()-t
+    pkts = np.concatenate([c[0] for c in chunks])
+    slots = np.concatenate([c[1] for c in chunks])
+
+    t = time.time()
+    ref = gen_probes_ref(template, slots)
+    t_ref = time.time()-t
+
+    if not np.all(pkts == ref):
+        ERROR('probe_stream and gen_probes_ref differ')
+    INFO('probes identical', pnum)
+    INFO('probe generation', 'vectorized: %.0f pkts/s   per probe: %.0f pkts/s' % (pnum/t_stream, pnum/t_ref))
+
+
+def test_pacing(n=2000, delta=1e-4, rate=0.1, spins=(0.0, 2e-4, np.inf), tx=None):
+    """ Paces n probes at geometrically distributed slots and prints
+    the send time error histogram for different spin thresholds. The
+    probes are written to /dev/null unless a transmit backend tx is
+    given. """
+    if tx is None:
+        tx = transmit.tx_pcapfile(os.devnull)
+    slots = np.cumsum(np.random.geometric(rate, size=n))
+    pkts = np.array(['\0'*60]*n)
+    errs = np.zeros(n)
+    t_run = monotonic()
+    for spin in spins:
+        t_start = monotonic()
+        paced_send(tx, pkts, (delta*slots + t_start).tolist(), errs, 0, spin)
+        hist = send_error_hist(delta)
+        hist.add(errs)
+        print 'spin threshold %g s' % spin
+        hist.pprint()
+    tx.close()
+    tx.report(monotonic() - t_run)
+
+
+def test_stream(pnum=10**6, size=PKT_CHUNK):
+    """ Measures the time until the first chunk of probes is
+    available and the generation throughput. """
+    t = time.time()
+    chunks = iter(probe_stream(test_template(), pnum, size))
+    chunks.next()
+    INFO('time to first chunk', '%.3f s (%d probes)' % (time.time()-t, size))
+    for c in chunks:
+        pass
+    t = time.time()-t
+    INFO('probe generation', '%.0f probes/s' % (pnum/t))
 
 
 
@@ -253,25 +530,19 @@ PKT_ARRAY_APPEND  = max((options.plen + ETHER_HDR_LEN) - PKT_ARRAY_WIDTH,0) # ne
 
 
 
-def sendpacket(pkt_str):
-    # pcap versions with different methods for injecting packets exist
-    if PCAP_INJECT==True:
-        s.inject(pkt_str, len(pkt_str))
-    elif PCAP_INJECT==False:
-        s.sendpacket(pkt_str)
-
-
 if not options.loaddump:
-    print 'pre-generating %i ICMP probes...' % (options.pnum), 
-    sys.stdout.flush()
-
-    # store send times as an slot index
-    slottimes = np.cumsum(np.random.geometric(options.rate, size=options.pnum)).astype(int)
-
-    # pre-generate all ICMP packets in an numpy array so we do not
-    # have to waste time at runtime
-    pkts = np.empty(options.pnum, dtype=np.dtype((str, PKT_ARRAY_WIDTH)))
-
-    probe_socket = gen_probes_raw()
-    s = probe_socket
+    # the probes are generated in chunks while sending, only the
+    # packet template is built here
+    try:
+        PROBE_TEMPLATE = probe_template()
+    except (MemoryError, ValueError):
+        ERROR("could not build probe packet!",2)
+    SLOT_SEED = np.random.randint(2**31)
+
+    # the backend is opened by each sendloop process (see open_tx)
+    TX_FILE = options.tx_file
+    if options.tx == 'file' and not TX_FILE:
+        savefile = options.savefile
+        hphelper.init_savefile('_tx.pcap', raw=True)
+        (TX_FILE, options.savefile) = (options.savefile, savefile)
 
@@ -0,0 +1,201 @@
+# Copyright 2014 IKT Leibniz Universitaet Hannover
+# GPL2
+# Zdravko Bozakov (zb@ikt.uni-hannover.de)
+
+import ctypes
+import ctypes.util
+import os
+import socket
+import struct
+import time
+
+import hphelper
+
+
+options = hphelper.options
+DEBUG = hphelper.DEBUG
+INFO = hphelper.INFO
+ERROR = hphelper.err
+
+
+class tx_backend(object):
+    """ Base class of the transmit backends used by the sender. Each
+    backend defines send, which transmits a single raw Ethernet frame;
+    send_many transmits a list of frames which are all due, using fewer
+    syscalls where the backend supports it (max_batch > 1). Each backend
+    counts the packets and the syscalls it issued. """
+
+    name = 'none'
+    max_batch = 1
+
+    def __init__(self):
+        self.packets = 0
+        self.syscalls = 0
+
+    def send_many(self, pkts):
+        for pkt in pkts:
+            self.send(pkt)
+
+    def close(self):
+        pass
+
+    def report(self, runtime):
+        """ Print the achieved packet rate and the syscall count """
+        INFO('tx backend', self.name)
+        INFO('tx rate', '%.0f packets/s (%d packets)' % (self.packets/max(runtime, 1e-9), self.packets))
+        INFO('tx syscalls', '%d (%.2f packets per syscall)' % (self.syscalls, 1.0*self.packets/max(self.syscalls, 1)))
+
+
+
+class tx_pcap(tx_backend):
+    """ Inject each frame through libpcap """
+
+    name = 'pcap'
+
+    def __init__(self, eth):
+        tx_backend.__init__(self)
+        import pcap               # python-pypcap
+        self.po = pcap.pcap(eth)
+        # pcap versions with different methods for injecting packets exist
+        if hasattr(self.po, 'inject'):
+            # ubuntu (python-pcap)
+            inject = self.po.inject
+            self._send = lambda pkt: inject(pkt, len(pkt))
+        else:
+            # use pcap.sendpacket instead
+            self._send = self.po.sendpacket
+
+    def send(self, pkt):
+        self._send(pkt)
+        self.packets += 1
+        self.syscalls += 1
+
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+class tx_packet(tx_backend):
+    """ Send the frames on a raw AF_PACKET socket bound to the
+    interface (Linux only). Frames which are due at the same time,
+    i.e., when the sender is late, are passed to the kernel with a
+    single sendmmsg call. """
+
+    name = 'packet'
+
+    def __init__(self, eth, max_batch=64):
+        tx_backend.__init__(self)
+        self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+        self.sock.bind((eth, 0))
+        self._send = self.sock.send
+        self.max_batch = 1
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._sendmmsg = libc.sendmmsg
+        except (OSError, AttributeError):
+            DEBUG('sendmmsg not available, sending one packet per syscall', __name__)
+            return
+
+        # the message headers are allocated once, each points to its iovec
+        self.iovs = (iovec*max_batch)()
+        self.msgs = (mmsghdr*max_batch)()
+        for k in xrange(max_batch):
+            self.msgs[k].msg_hdr.msg_iov = ctypes.pointer(self.iovs[k])
+            self.msgs[k].msg_hdr.msg_iovlen = 1
+        self.max_batch = max_batch
+
+    def send(self, pkt):
+        self._send(pkt)
+        self.packets += 1
+        self.syscalls += 1
+
+    def send_many(self, pkts):
+        n = len(pkts)
+        if n == 1 or self.max_batch == 1:
+            return tx_backend.send_many(self, pkts)
+        iovs = self.iovs
+        for (k, pkt) in enumerate(pkts):
+            iovs[k].iov_base = ctypes.cast(ctypes.c_char_p(pkt), ctypes.c_void_p)
+            iovs[k].iov_len = len(pkt)
+        i = 0
+        fd = self.sock.fileno()
+        while i < n:
+            sent = self._sendmmsg(fd, ctypes.byref(self.msgs, i*ctypes.sizeof(mmsghdr)), n-i, 0)
+            self.syscalls += 1
+            if sent < 0:
+                e = ctypes.get_errno()
+                raise socket.error(e, os.strerror(e))
+            i += sent
+        self.packets += n
+
+    def close(self):
+        self.sock.close()
+
+
+
+class tx_pcapfile(tx_backend):
+    """ Write the frames with their send timestamps to a pcap file
+    instead of sending them, e.g., for testing without an interface.
+    Frames are buffered and written with one write call per max_buf
+    frames. """
+
+    name = 'file'
+
+    def __init__(self, fname, max_buf=1024):
+        tx_backend.__init__(self)
+        self.fname = fname
+        self.fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        # pcap file header: magic, version 2.4, UTC, accuracy, snaplen, Ethernet
+        os.write(self.fd, struct.pack('IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+        self.syscalls += 1
+        self.max_buf = max_buf
+        self.buf = []
+
+    def send(self, pkt):
+        t = time.time()
+        sec = int(t)
+        self.buf.append(struct.pack('IIII', sec, int((t-sec)*1e6), len(pkt), len(pkt)))
+        self.buf.append(pkt)
+        self.packets += 1
+        if len(self.buf) >= 2*self.max_buf:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            os.write(self.fd, ''.join(self.buf))
+            self.syscalls += 1
+            self.buf = []
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+        INFO('tx file', self.fname)
+
+
+
+TX_BACKENDS = ['pcap', 'packet', 'file']
+
+
+def open_tx(name, eth=None, fname=None):
+    """ Open the transmit backend name (see TX_BACKENDS) on the
+    interface eth. The file backend writes to fname. """
+    try:
+        if name == 'pcap':
+            return tx_pcap(eth)
+        elif name == 'packet':
+            return tx_packet(eth)
+        elif name == 'file':
+            return tx_pcapfile(fname)
+    except Exception as e:
+        ERROR('could not open %s transmit backend: %s' % (name, e))
+    ERROR('unknown transmit backend: %s' % name)